@@ -0,0 +1,117 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import streamlit as st
+
+from llm_gateway import LLMErrorResult
+from tracing import record_cache
+
+# Cosine similarity above which two questions about the same context share an answer.
+ANSWER_SIMILARITY_THRESHOLD = 0.92
+ANSWER_CACHE_MAX_ENTRIES = 1024
+ANSWER_CACHE_TTL_SECONDS = 24 * 3600
+# Results that must not be cached because they describe a failure rather than an answer.
+_ERROR_PREFIXES = ("An error", "API Client is not initialized", "Could not generate a valid answer")
+
+def _normalize_question(question: str) -> str:
+    return " ".join(question.lower().split())
+
+def _context_key(context: str) -> str:
+    return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+class SemanticAnswerCache:
+    """
+    Process-wide QA answer cache. A question hits when the same retrieved context was
+    answered before for the same (normalized) question, or for a question whose unit
+    embedding is within `similarity_threshold`. Entries are evicted least-recently-used
+    beyond `max_entries` and expire after `ttl_seconds`.
+    """
+
+    def __init__(self, similarity_threshold: float = ANSWER_SIMILARITY_THRESHOLD,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # (context key, normalized question) -> {"question", "vector", "answer", "created_at"};
+        # "vector" stays None until a semantic lookup against that context needs it.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def _expire(self, now: float):
+        expired = [key for key, entry in self._entries.items() if now - entry["created_at"] > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        self._counters["expirations"] += len(expired)
+
+    def lookup(self, question: str, context: str, embed_fn):
+        """
+        Returns the cached answer or None. `embed_fn(question)` must return a unit vector;
+        it is only called when no exact match exists but the context has cached answers,
+        which are then embedded too if they have not been yet.
+        """
+        context_key, question_key = _context_key(context), _normalize_question(question)
+        with self._lock:
+            self._expire(time.time())
+            exact = self._entries.get((context_key, question_key))
+            if exact is not None:
+                self._entries.move_to_end((context_key, question_key))
+                self._counters["exact_hits"] += 1
+                record_cache("answer", hits=1)
+                return exact["answer"]
+            candidates = [(key, entry) for key, entry in self._entries.items() if key[0] == context_key]
+        if not candidates:
+            with self._lock:
+                self._counters["misses"] += 1
+            record_cache("answer", misses=1)
+            return None
+
+        for _, entry in candidates:
+            if entry["vector"] is None:
+                vector = np.asarray(embed_fn(entry["question"]), dtype=np.float32)
+                with self._lock:
+                    entry["vector"] = vector
+        question_vector = embed_fn(question)
+        similarities = np.stack([entry["vector"] for _, entry in candidates]) @ question_vector
+        best = int(np.argmax(similarities))
+        with self._lock:
+            if similarities[best] >= self.similarity_threshold and candidates[best][0] in self._entries:
+                self._entries.move_to_end(candidates[best][0])
+                self._counters["semantic_hits"] += 1
+                record_cache("answer", hits=1)
+                return candidates[best][1]["answer"]
+            self._counters["misses"] += 1
+        record_cache("answer", misses=1)
+        return None
+
+    def store(self, question: str, context: str, answer: str) -> bool:
+        """
+        Caches an answer; failures are not stored. Returns whether it was stored. The question
+        is embedded lazily by `lookup`, so storing never loads the embedding model.
+        """
+        if not answer or isinstance(answer, LLMErrorResult) or answer.startswith(_ERROR_PREFIXES):
+            return False
+        key = (_context_key(context), _normalize_question(question))
+        entry = {"question": question, "vector": None, "answer": answer, "created_at": time.time()}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters, size=len(self._entries))
+        hits = counters["exact_hits"] + counters["semantic_hits"]
+        lookups = hits + counters["misses"]
+        counters.update(hits=hits, lookups=lookups, hit_rate=(hits / lookups) if lookups else 0.0)
+        return counters
+
+@st.cache_resource
+def get_answer_cache() -> SemanticAnswerCache:
+    return SemanticAnswerCache()
@@ -5,13 +5,16 @@ import os
 import pandas as pd
 import base64
 from io import BytesIO
-from pathlib import Path
-import shutil
 
-from qa import create_document_index, find_context_in_relevant_chapter
-from summarizer_engine import load_summary_data, get_chapter_text
-from chat import get_summary, get_qa_answer
-from eval import run_consensus_evaluation
+from qa import encode_query
+from corpus import get_corpus_registry
+from summarizer_engine import get_chapter_text
+from chat import (get_summary, get_qa_answer, theme_prompt_title, stream_qa_answer, stream_summary, ttft_stats,
+                  num_tokens_from_string, qa_context_budget)
+from summary_cache import get_summary_cache
+from answer_cache import get_answer_cache
+from eval import cascade_stats, run_consensus_evaluation, log_single_model_result
+from tracing import METRICS_PORT, TRACER, span, start_metrics_server
 from style import create_header,apply_global_styles
 
 # ==============================================================================
@@ -26,26 +29,38 @@ BANNER_PATH = "./images/bishop_logo_2.jpg"
 BANNER_HEIGHT = 150
 
 groq_key = st.secrets["GROQ_API_KEY"]
-api_ninja_key = st.secrets["API_NINJA_KEY"]
+# Only needed when SIMILARITY_BACKEND is "api"; consensus scoring is local by default.
+api_ninja_key = st.secrets.get("API_NINJA_KEY")
 
 QA_MODELS_TO_EVALUATE = ["gemma2-9b-it", "llama3-8b-8192", "llama3-70b-8192"]
+# Context tokens per question: the smallest budget of the models that will read it.
+QA_CONTEXT_TOKENS = qa_context_budget(QA_MODELS_TO_EVALUATE)
 # Based on Phase 1 results, llama3-8b is the best for summarization. We will use it exclusively.
 SUMMARY_MODEL = "llama3-70b-8192" 
+# UI label -> qa retrieval mode
+SEARCH_SCOPES = {"Auto": "auto", "Best chapter": "chapter", "Whole document": "global", "Keywords + meaning": "hybrid"}
 
 
-SUMMARY_DATA = load_summary_data(PDF_PATH, TOC_PATH)
-TEXT_CHUNKS, CHUNK_EMBEDDINGS = create_document_index(PDF_PATH)
+# Documents listed in data/corpus.json (or just PDF_PATH/TOC_PATH), each with an index bundle prebuilt by
+# `python index_bundle.py --corpus`; bundles are loaded on first use and built by that command in a child process when missing or stale.
+CORPUS = get_corpus_registry()
+DOCUMENT_IDS = CORPUS.document_ids
+AUTO_DOCUMENT = "All documents"
+DEFAULT_INDEXES = CORPUS.get(DOCUMENT_IDS[0])
+SUMMARY_DATA, TEXT_CHUNKS = DEFAULT_INDEXES.summary_data, DEFAULT_INDEXES.text_chunks
+SUMMARY_CACHE = get_summary_cache()
+ANSWER_CACHE = get_answer_cache()
 
 try:
-    groq_client = Groq(api_key=st.secrets["GROQ_API_KEY"])
+    # Retries are left to the LLM gateway, which honours Retry-After across all callers.
+    groq_client = Groq(api_key=st.secrets["GROQ_API_KEY"], max_retries=0)
 except Exception as e: 
     st.error(f"Groq API client error: {e}"); st.stop()
 
 
-log_dir = Path("logs")
-if log_dir.exists():
-    shutil.rmtree(log_dir)
-log_dir.mkdir()
+# Prometheus text metrics for scraping, e.g. METRICS_PORT=9100 -> http://host:9100/metrics
+if METRICS_PORT:
+    start_metrics_server(int(METRICS_PORT))
 
 # ==============================================================================
 # PAGE CONFIGURATION AND HEADER
@@ -71,6 +86,7 @@ if 'qa_best_answer' not in st.session_state: st.session_state.qa_best_answer = "
 if 'summary_best_summary' not in st.session_state: st.session_state.summary_best_summary = ""
 # Add session state to store the source chapter
 if 'qa_source_chapter' not in st.session_state: st.session_state.qa_source_chapter = ""
+if 'qa_context_tokens' not in st.session_state: st.session_state.qa_context_tokens = None
 
 
 if not SUMMARY_DATA or TEXT_CHUNKS is None:
@@ -83,29 +99,60 @@ else:
         with st.container(border=True):
             st.subheader("Any Question?")
             question = st.text_input("Enter your question here:", placeholder="e.g., How much are the tuition fees?")
+            search_scope = st.radio(
+                "Search in:", list(SEARCH_SCOPES), horizontal=True, key="search_scope",
+                help="Auto answers keyword questions by keyword search and searches the whole document when no chapter is a confident match."
+            )
             
+            qa_document_id = None
+            if len(DOCUMENT_IDS) > 1:
+                qa_document = st.selectbox("Document:", [AUTO_DOCUMENT] + DOCUMENT_IDS, key="qa_document",
+                                           format_func=lambda doc_id: doc_id if doc_id == AUTO_DOCUMENT else CORPUS.title(doc_id))
+                qa_document_id = None if qa_document == AUTO_DOCUMENT else qa_document
+
             if st.button("Get Answer", use_container_width=True, key="qa_button"):
                 if question:
-                    with st.spinner("Finding relevant chapter and generating answer..."):
+                    with st.spinner("Finding relevant chapter and generating answer..."), span("qa.request", scope=search_scope):
                         
-                        context_and_source = find_context_in_relevant_chapter(
-                            question, SUMMARY_DATA
+                        context_and_source = CORPUS.find_context(
+                            question, retrieval_mode=SEARCH_SCOPES[search_scope], document_id=qa_document_id,
+                            context_tokens=QA_CONTEXT_TOKENS
                         )
                         
                         if context_and_source:
-                            relevant_context, source_chapter = context_and_source
+                            relevant_context, source_chapter, source_document = context_and_source
+                            st.session_state.qa_context_tokens = num_tokens_from_string(relevant_context)
                             #st.session_state.qa_source_chapter = f"Source: Based on the '{source_chapter}' chapter."
 
-                            qa_report = run_consensus_evaluation(
-                                client=groq_client,
-                                models=QA_MODELS_TO_EVALUATE,
-                                task_type='qa',
-                                context=relevant_context,
-                                prompt=question
-                            )
-                            st.session_state.qa_best_answer = qa_report["best_result"]
+                            cached_answer = ANSWER_CACHE.lookup(question, relevant_context, encode_query)
+                            if cached_answer is not None:
+                                st.session_state.qa_best_answer = cached_answer
+                            else:
+                                if len(QA_MODELS_TO_EVALUATE) == 1:
+                                    # A single model needs no consensus, so its answer is streamed as it is generated.
+                                    answer_preview = st.empty()
+                                    answer_stream = stream_qa_answer(groq_client, question, relevant_context, QA_MODELS_TO_EVALUATE[0])
+                                    with answer_preview.container():
+                                        best_answer = st.write_stream(answer_stream)
+                                    answer_preview.empty()
+                                    if answer_stream.error is not None:
+                                        # A stream that broke off is an error, not an answer: it is logged as such and never cached.
+                                        best_answer = answer_stream.error
+                                    log_single_model_result('qa', QA_MODELS_TO_EVALUATE[0], best_answer)
+                                else:
+                                    qa_report = run_consensus_evaluation(
+                                        client=groq_client,
+                                        models=QA_MODELS_TO_EVALUATE,
+                                        task_type='qa',
+                                        context=relevant_context,
+                                        prompt=question
+                                    )
+                                    best_answer = qa_report["best_result"]
+                                st.session_state.qa_best_answer = best_answer
+                                ANSWER_CACHE.store(question, relevant_context, best_answer)
                         else:
                             st.session_state.qa_source_chapter = ""
+                            st.session_state.qa_context_tokens = None
                             st.session_state.qa_best_answer = "Sorry, I could not find a relevant chapter in the document to answer your question."
                 else:
                     st.warning("Please enter a question.")
@@ -116,27 +163,78 @@ else:
 
             st.text_area("Best Answer", value=st.session_state.qa_best_answer, height=500, disabled=True)
 
+            if st.session_state.qa_context_tokens is not None:
+                st.caption(f"Context: {st.session_state.qa_context_tokens} tokens (budget {QA_CONTEXT_TOKENS})")
+            for level, routing_stats in CORPUS.routing_stats().items():
+                if routing_stats["count"]:
+                    st.caption(
+                        f"{level.capitalize()} routing over {routing_stats['count']} question(s): "
+                        f"p50 {routing_stats['p50_ms']:.1f} ms, p95 {routing_stats['p95_ms']:.1f} ms"
+                    )
+            answer_cache_stats = ANSWER_CACHE.stats()
+            if answer_cache_stats["lookups"]:
+                st.caption(
+                    f"Answer cache: {answer_cache_stats['hit_rate']:.0%} hit rate over "
+                    f"{answer_cache_stats['lookups']} lookup(s), {answer_cache_stats['size']} cached answer(s)"
+                )
+            for model_name, model_ttft in ttft_stats().items():
+                st.caption(
+                    f"Time to first token, {model_name} ({model_ttft['count']} streamed): "
+                    f"p50 {model_ttft['p50_ms']:.0f} ms, p95 {model_ttft['p95_ms']:.0f} ms"
+                )
+
     # Chapter-Based Summarizer 
     with col2:
         with st.container(border=True):
             st.subheader("Summarize this, please")
-            theme_titles = [item['title'] for item in SUMMARY_DATA]
+            summary_document_id = DOCUMENT_IDS[0]
+            if len(DOCUMENT_IDS) > 1:
+                summary_document_id = st.selectbox("Document:", DOCUMENT_IDS, key="summary_document", format_func=CORPUS.title)
+            document_chapters = CORPUS.get(summary_document_id).summary_data
+            theme_titles = [item['title'] for item in document_chapters]
             selected_theme_title = st.selectbox("Choose a subject to summarize:", theme_titles)
-            selected_theme_text = get_chapter_text(SUMMARY_DATA, selected_theme_title)
+            selected_theme_text = get_chapter_text(document_chapters, selected_theme_title)
 
             if st.button("Generate Summary", use_container_width=True, key="summary_button"):
-                with st.spinner(f"Generating summary with {SUMMARY_MODEL}..."):
-                    summary_report = run_consensus_evaluation(
-                        client=groq_client,
-                        models=[SUMMARY_MODEL],
-                        task_type='summary',
-                        context=selected_theme_text,
-                        prompt=selected_theme_title
-                    )
-                    st.session_state.summary_best_summary = summary_report["best_result"]
+                summary_prompt_title = theme_prompt_title(selected_theme_title)
+                cached_summary = SUMMARY_CACHE.get(selected_theme_text, SUMMARY_MODEL, summary_prompt_title)
+                if cached_summary is not None:
+                    st.session_state.summary_best_summary = cached_summary
+                else:
+                    with st.spinner(f"Generating summary with {SUMMARY_MODEL}..."), span("summary.request", model=SUMMARY_MODEL):
+                        # Long chapters are summarized in parts first; the final synthesis is streamed.
+                        summary_preview = st.empty()
+                        summary_stream = stream_summary(groq_client, selected_theme_text, SUMMARY_MODEL, summary_prompt_title)
+                        with summary_preview.container():
+                            best_summary = st.write_stream(summary_stream)
+                        summary_preview.empty()
+                        if summary_stream.error is not None:
+                            # A stream that broke off is an error, not a summary: it is logged as such and never cached.
+                            best_summary = summary_stream.error
+                        log_single_model_result('summary', SUMMARY_MODEL, best_summary)
+                        st.session_state.summary_best_summary = best_summary
+                        # Only a summary built from every part is kept; one with failed parts is shown but not cached.
+                        if summary_stream.complete:
+                            SUMMARY_CACHE.put(selected_theme_text, SUMMARY_MODEL, summary_prompt_title, best_summary)
             
             st.text_area("Best Summary", value=st.session_state.summary_best_summary, height=500, disabled=True)
         
+# Per-stage wall time, LLM tokens and cache hits since the process started (see tracing.py).
+with st.expander("Performance"):
+    trace_stats = TRACER.stats()
+    if trace_stats["spans"]:
+        stage_table = pd.DataFrame.from_dict(trace_stats["spans"], orient="index").sort_values("total_s", ascending=False)
+        st.dataframe(stage_table, use_container_width=True)
+    if trace_stats["tokens"]:
+        st.dataframe(pd.DataFrame.from_dict(trace_stats["tokens"], orient="index"), use_container_width=True)
+    if trace_stats["caches"]:
+        st.dataframe(pd.DataFrame.from_dict(trace_stats["caches"], orient="index"), use_container_width=True)
+    if cascade_stats():
+        st.caption("Cascaded consensus: models called before the run was resolved")
+        st.dataframe(pd.DataFrame(cascade_stats()), use_container_width=True, hide_index=True)
+    if not trace_stats["spans"]:
+        st.caption("Nothing traced yet.")
+
 st.markdown(
     """
     <div style="text-align: center; color: grey;">
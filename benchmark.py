@@ -0,0 +1,221 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import eval_log
+from chat import get_summary, num_tokens_from_string, theme_prompt_title
+from eval import CONSENSUS_MODES, run_consensus_evaluation
+from index_bundle import load_index_bundle
+from qa import (RETRIEVAL_MODES, create_document_index, encode_query, find_context_in_relevant_chapter, get_query_encoder,
+                latency_stats)
+from rate_limit import TokenBucket, get_rate_limiter
+from summarizer_engine import extract_pages, load_summary_data
+from tracing import JsonlSink
+
+BENCHMARK_DIR = Path("benchmarks")
+CONSENSUS_MODELS = ["gemma2-9b-it", "llama3-8b-8192", "llama3-70b-8192"]
+# Simulated sessions asking distinct questions at the same time.
+CONCURRENT_SESSIONS = 8
+BENCHMARK_QUESTIONS = [
+    "How much are the tuition fees for international students?",
+    "When is the last day to withdraw from a course without academic penalty?",
+    "What are the admission requirements for mature students?",
+    "What is the academic standing policy for students on probation?",
+    "Which courses are required for the Honours in Biology?",
+    "BIO 117",
+    "How do I apply for a scholarship?",
+    "What happens if I plagiarize an assignment?",
+]
+
+class StubLLMClient:
+    """
+    Stands in for groq.Groq: every completion sleeps `latency` seconds (a per-model dict
+    is allowed) and returns words picked deterministically from the prompt, so runs are
+    repeatable and consensus answers from different models partly agree.
+    """
+
+    def __init__(self, latency=0.0, answer_words: int = 80):
+        self.latency = latency
+        self.answer_words = answer_words
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _answer(self, model: str, prompt: str) -> str:
+        words = prompt.split() or ["empty"]
+        seed = int(hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest(), 16)
+        start = seed % max(1, len(words) - self.answer_words)
+        return " ".join(words[start:start + self.answer_words])
+
+    def _create(self, model: str, messages: list, stream: bool = False, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency.get(model, 0.0) if isinstance(self.latency, dict) else self.latency)
+        text = self._answer(model, messages[-1]["content"])
+        usage = types.SimpleNamespace(prompt_tokens=len(messages[-1]["content"]) // 4,
+                                      completion_tokens=len(text) // 4, total_tokens=0)
+        if stream:
+            return (types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=word + " "))])
+                    for word in text.split())
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))],
+                                     usage=usage)
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS; it is the peak of the whole run so far.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == "Darwin" else peak / 1024
+
+def measure(name: str, fn, iterations: int, setup=None, **extra) -> dict:
+    """Calls `fn` once untimed, then `iterations` times; `setup` runs untimed before each call."""
+    if setup:
+        setup()
+    fn()
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    total = sum(samples)
+    result = {"name": name, "ops": iterations, "seconds": round(total, 4),
+              "ops_per_s": round(iterations / total, 3) if total else None,
+              **latency_stats(samples), "peak_rss_mb": round(_peak_rss_mb(), 1)}
+    result.update(extra)
+    print(f"{name:<40} {result['ops_per_s'] or 0:>10.2f} ops/s  p50 {result['p50_ms']:>9.2f} ms  "
+          f"p95 {result['p95_ms']:>9.2f} ms  peak RSS {result['peak_rss_mb']:.0f} MB")
+    return result
+
+def run_benchmarks(pdf_path: str, toc_path: str, iterations: int, latency: float) -> list:
+    """
+    Times the ingestion, retrieval, token counting and LLM paths. Ingestion benchmarks
+    clear Streamlit's in-process caches before each call, so they measure a restarted
+    process (the on-disk page, embedding and index caches stay warm).
+    """
+    results = []
+
+    def fresh_summary_data():
+        load_summary_data.clear()
+        extract_pages.clear()
+    results.append(measure("load_summary_data", lambda: load_summary_data(pdf_path, toc_path),
+                           iterations, setup=fresh_summary_data))
+    results.append(measure("create_document_index", lambda: create_document_index(pdf_path),
+                           iterations, setup=create_document_index.clear))
+
+    indexes = load_index_bundle(pdf_path, toc_path)
+    for mode in RETRIEVAL_MODES:
+        def retrieve_all(mode=mode):
+            for question in BENCHMARK_QUESTIONS:
+                find_context_in_relevant_chapter(
+                    question, indexes.summary_data, indexes.section_index,
+                    text_chunks=indexes.text_chunks, chunk_embeddings=indexes.chunk_embeddings,
+                    retrieval_mode=mode, lexical_index=indexes.lexical_index, chapter_router=indexes.chapter_router
+                )
+        # Each op is one pass over the questions; the query-embedding cache is cleared so every question is encoded.
+        results.append(measure(f"find_context[{mode}]", retrieve_all, iterations, setup=get_query_encoder().clear_cache,
+                               questions_per_op=len(BENCHMARK_QUESTIONS)))
+
+    # Every session encodes every question at once; the shared encoder batches them across sessions.
+    questions = [f"{question} (session {session})" for session in range(CONCURRENT_SESSIONS)
+                 for question in BENCHMARK_QUESTIONS]
+    batches_before = get_query_encoder().stats()["batches"]
+    with ThreadPoolExecutor(max_workers=CONCURRENT_SESSIONS) as sessions:
+        results.append(measure(f"encode_query[{CONCURRENT_SESSIONS} sessions]",
+                               lambda: list(sessions.map(encode_query, questions)), iterations,
+                               setup=get_query_encoder().clear_cache, questions_per_op=len(questions)))
+    results[-1]["mean_batch_size"] = round(
+        len(questions) * (iterations + 1) / max(1, get_query_encoder().stats()["batches"] - batches_before), 2)
+
+    chapter_texts = [item['text'] for item in indexes.summary_data]
+    results.append(measure("num_tokens_from_string", lambda: [num_tokens_from_string(text) for text in chapter_texts],
+                           iterations, chapters_per_op=len(chapter_texts),
+                           characters_per_op=sum(len(text) for text in chapter_texts)))
+
+    # The longest chapter exercises the map-reduce path; an unlimited bucket keeps the stub free of quota waits.
+    longest = max(indexes.summary_data, key=lambda item: len(item['text']))
+    client = StubLLMClient(latency)
+    unlimited = TokenBucket(10 ** 9, 10 ** 12)
+    calls_before = client.calls
+    results.append(measure("get_summary[map-reduce]", lambda: get_summary(
+        client, longest['text'], "llama3-70b-8192", theme_prompt_title(longest['title']), rate_limiter=unlimited
+    ), iterations, chapter=longest['title'], stub_latency_s=latency))
+    results[-1]["llm_calls_per_op"] = (client.calls - calls_before) / (iterations + 1)
+
+    context = indexes.summary_data[0]['text'][:4000]
+    # Consensus calls use each model's shared limiter; create those unlimited too, before anything else does.
+    for model in CONSENSUS_MODELS:
+        get_rate_limiter(model, 10 ** 9, 10 ** 12)
+    # Consensus runs are logged like in the app (queued for the background writer), to a scratch file.
+    default_log = eval_log.EVAL_LOG
+    with tempfile.TemporaryDirectory() as scratch:
+        eval_log.EVAL_LOG = JsonlSink(Path(scratch) / "evaluations.jsonl", eval_log.EVAL_LOG_MAX_BYTES,
+                                      eval_log.EVAL_LOG_BACKUPS, eval_log.EVAL_LOG_QUEUE_SIZE, "evaluation log")
+        try:
+            for mode in CONSENSUS_MODES:
+                calls_before = client.calls
+                results.append(measure(f"run_consensus_evaluation[qa, {mode}]", lambda mode=mode: run_consensus_evaluation(
+                    client, CONSENSUS_MODELS, "qa", context, BENCHMARK_QUESTIONS[0], mode=mode
+                ), iterations, models=len(CONSENSUS_MODELS), stub_latency_s=latency))
+                results[-1]["llm_calls_per_op"] = (client.calls - calls_before) / (iterations + 1)
+        finally:
+            eval_log.EVAL_LOG.flush()
+            eval_log.EVAL_LOG = default_log
+    return results
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(results: list, baseline_path: str):
+    """Prints the ops/s change of each benchmark against a previous results file."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    print(f"\nChange against {baseline_path}:")
+    for result in results:
+        before = baseline.get(result["name"])
+        if before and before.get("ops_per_s") and result.get("ops_per_s"):
+            change = result["ops_per_s"] / before["ops_per_s"] - 1.0
+            print(f"{result['name']:<40} {change:>+8.1%} ops/s  p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths against the source PDF with a stub LLM client.")
+    parser.add_argument("--pdf", default="./data/BU.pdf")
+    parser.add_argument("--toc", default="./data/toc.json")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the stub client waits per completion.")
+    parser.add_argument("--out", help="Results file (default: benchmarks/<git commit>.json).")
+    parser.add_argument("--compare", help="A previous results file to compare against.")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = run_benchmarks(args.pdf, args.toc, args.iterations, args.latency)
+    report = {
+        "commit": commit,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"pdf": args.pdf, "toc": args.toc, "iterations": args.iterations, "stub_latency_s": args.latency},
+        "results": results,
+    }
+    out_path = Path(args.out) if args.out else BENCHMARK_DIR / f"{commit}.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote benchmark results to '{out_path}'.")
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import heapq
+import math
+import re
+from array import array
+from collections import Counter
+
+# Keeps course codes ("BCS216"), dates ("2019-2020") and abbreviations ("m.ed") as single tokens.
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.'’\-–][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it me my of on or the to "
+    "what when where which who why will with you your".split()
+)
+
+def tokenize(text: str) -> list:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """
+    A compact in-memory inverted index with Okapi BM25 scoring. Postings are stored as
+    parallel int arrays (document ids, term frequencies) per term.
+    """
+
+    def __init__(self, documents: list, k1: float = 1.5, b: float = 0.75):
+        self.k1, self.b = k1, b
+        self.doc_count = len(documents)
+        self.doc_lengths = array("I")
+        self.postings = {}
+        for doc_id, text in enumerate(documents):
+            term_counts = Counter(tokenize(text))
+            self.doc_lengths.append(sum(term_counts.values()))
+            for term, tf in term_counts.items():
+                doc_ids, tfs = self.postings.setdefault(term, (array("I"), array("I")))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        self.avg_doc_length = (sum(self.doc_lengths) / self.doc_count) if self.doc_count else 0.0
+        self.idf = {
+            term: math.log(1 + (self.doc_count - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            for term, (doc_ids, _) in self.postings.items()
+        }
+
+    def search(self, query: str, k: int = 10) -> list:
+        """Top-k (document id, BM25 score) pairs, best first. Unknown terms are ignored."""
+        scores = {}
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            doc_ids, tfs = self.postings[term]
+            idf = self.idf[term]
+            for doc_id, tf in zip(doc_ids, tfs):
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_doc_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """
+    Fuses several ranked lists of (document id, score) into one list of
+    (document id, fused score), using only ranks: score = sum(1 / (k + rank)).
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, (doc_id, _) in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
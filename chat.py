@@ -1,71 +1,373 @@
-import tiktoken
+import math
+import re
+import threading
 import time
+import tiktoken
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from llm_gateway import LLMErrorResult, error_result, get_gateway
+from rate_limit import get_rate_limiter
+from tracing import TRACER, annotate, record_usage, traced
+
+# Upper bound on concurrent map-phase calls; the rate limiter decides the actual pace.
+SUMMARY_MAP_WORKERS = 4
+# Tokens charged for each completion when drawing from the tokens-per-minute budget.
+EXPECTED_COMPLETION_TOKENS = 500
+
+# Context windows of the Groq models we use; unknown models get DEFAULT_CONTEXT_WINDOW.
+MODEL_CONTEXT_WINDOWS = {"gemma2-9b-it": 8192, "llama3-8b-8192": 8192, "llama3-70b-8192": 8192}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Context room kept free for the prompt instructions and for the completion itself.
+PROMPT_OVERHEAD_TOKENS = 150
+COMPLETION_TOKEN_RESERVE = 1024
+# Bound on how many times partial summaries are merged before the final synthesis.
+MAX_REDUCE_LEVELS = 4
+# Tokens of retrieved context put in a QA prompt, per model; bounds each answer's latency and cost.
+QA_CONTEXT_TOKENS = {"gemma2-9b-it": 1500, "llama3-8b-8192": 1500, "llama3-70b-8192": 2500}
+DEFAULT_QA_CONTEXT_TOKENS = 1500
+
+# Summary prompts. They are part of the summary cache key, so editing one invalidates cached summaries.
+SUMMARY_PROMPT = "Please provide a concise summary of {title}:\n\n{text}"
+SUMMARY_PART_PROMPT = "This is part {number} of a larger document. Please summarize just this part:\n\n{text}"
+SUMMARY_MERGE_PROMPT = "Combine these consecutive partial summaries into one summary:\n\n{text}"
+SUMMARY_FINAL_PROMPT = "Synthesize these partial summaries into one final, comprehensive summary:\n\n{text}"
+SUMMARY_PROMPT_TEMPLATES = (SUMMARY_PROMPT, SUMMARY_PART_PROMPT, SUMMARY_MERGE_PROMPT, SUMMARY_FINAL_PROMPT)
+
+NOT_ENOUGH_CONTEXT_ANSWER = "I'm sorry, the document does not contain enough relevant information to answer that question."
+
+# Recent time-to-first-token samples (seconds) per model, from the streaming functions.
+TTFT_WINDOW = 500
+_ttft_samples = {}
+_ttft_lock = threading.Lock()
+
+def theme_prompt_title(theme: str) -> str:
+    """The prompt_title used when summarizing a chapter (theme) of the document."""
+    return f"the theme '{theme}'"
+
+@lru_cache(maxsize=None)
+def _get_encoding(model_name: str):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
 
 # count tokens in a string.
 def num_tokens_from_string(string: str, model_name: str = "gpt-3.5-turbo") -> int:
-   
+    return len(_get_encoding(model_name).encode(string))
+
+def summary_input_budget(model_name: str, rate_limiter=None) -> int:
+    """
+    Tokens of document text that fit in one summarization prompt for this model: within
+    its context window and, since the API rejects any request larger than the per-minute
+    token quota, within the quota of `rate_limiter` (the model's shared limiter by default).
+    """
+    context_window = MODEL_CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW)
+    budget = context_window - PROMPT_OVERHEAD_TOKENS - COMPLETION_TOKEN_RESERVE
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter(model_name)
+    if rate_limiter.tokens_per_minute:
+        budget = min(budget, max(1, int(rate_limiter.tokens_per_minute) - PROMPT_OVERHEAD_TOKENS - COMPLETION_TOKEN_RESERVE))
+    return budget
+
+def qa_context_budget(model_names) -> int:
+    """Context tokens for a QA prompt sent to all of `model_names` (the smallest of their budgets)."""
+    return min(min(QA_CONTEXT_TOKENS.get(model_name, DEFAULT_QA_CONTEXT_TOKENS), summary_input_budget(model_name))
+               for model_name in model_names)
+
+def _token_pieces(text: str, max_tokens: int, encoding):
+    """
+    Yields (piece, token_count) covering `text` in order, each piece at most max_tokens.
+    Cuts at paragraph breaks, then at line breaks, and only then inside a line.
+    """
+    parts = re.split(r'(\n\s*\n)', text)
+    # Keep each paragraph's trailing blank line attached to it.
+    paragraphs = ["".join(parts[i:i + 2]) for i in range(0, len(parts), 2)]
+    for paragraph in paragraphs:
+        tokens = encoding.encode(paragraph)
+        if len(tokens) <= max_tokens:
+            yield paragraph, len(tokens)
+            continue
+        for line in paragraph.splitlines(keepends=True):
+            tokens = encoding.encode(line)
+            if len(tokens) <= max_tokens:
+                yield line, len(tokens)
+                continue
+            for start in range(0, len(tokens), max_tokens):
+                window = tokens[start:start + max_tokens]
+                yield encoding.decode(window), len(window)
+
+def split_text_by_tokens(text: str, max_tokens: int, model_name: str = "gpt-3.5-turbo") -> list:
+    """
+    Packs `text` into consecutive chunks of at most max_tokens tokens, preferring
+    paragraph and line boundaries. The text is tokenized once, piece by piece, and the
+    chunk count also answers whether the text fits in a single prompt.
+    """
+    # Every token spans at least one UTF-8 byte, so short texts need no tokenization.
+    if len(text.encode("utf-8")) <= max_tokens:
+        return [text]
+    chunks, current, current_tokens = [], [], 0
+    for piece, n_tokens in _token_pieces(text, max_tokens, _get_encoding(model_name)):
+        if current and current_tokens + n_tokens > max_tokens:
+            chunks.append("".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += n_tokens
+    if current:
+        chunks.append("".join(current))
+    return [chunk for chunk in chunks if chunk.strip()] or [text]
+
+def _token_cost(model_name: str, prompt: str) -> int:
+    return num_tokens_from_string(prompt, model_name) + EXPECTED_COMPLETION_TOKENS
+
+def _completion(client, model_name: str, prompt: str, rate_limiter=None, error_prefix: str = "An error occurred") -> str:
+    """The completion text, or an LLMErrorResult; retries and quota waits happen in the gateway."""
+    return get_gateway().complete(client, model_name, prompt, _token_cost(model_name, prompt), rate_limiter, error_prefix)
+
+def _record_ttft(model_name: str, seconds: float):
+    with _ttft_lock:
+        _ttft_samples.setdefault(model_name, deque(maxlen=TTFT_WINDOW)).append(seconds)
+
+def ttft_stats() -> dict:
+    """Time-to-first-token p50/p95 in milliseconds per model, over recent streamed answers."""
+    with _ttft_lock:
+        samples = {model: list(values) for model, values in _ttft_samples.items()}
+    stats = {}
+    for model, values in samples.items():
+        ordered = sorted(values)
+        # Nearest-rank percentiles.
+        stats[model] = {
+            "count": len(ordered),
+            "p50_ms": 1000.0 * ordered[max(0, math.ceil(0.50 * len(ordered)) - 1)],
+            "p95_ms": 1000.0 * ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)],
+        }
+    return stats
+
+def stream_completion(client, model_name: str, prompt: str, rate_limiter=None, started_at: float = None):
+    """
+    Yields the completion text piece by piece (Groq `stream=True`) and records the time
+    to the first token, measured from `started_at` (default: now) for this model.
+    Opening the stream goes through the gateway (quota, retries) with the model's shared
+    limiter unless `rate_limiter` is given.
+    """
+    if started_at is None:
+        started_at = time.perf_counter()
+    # Traced by hand: a span left open across yields would become the parent of the caller's spans.
+    stream_start, ttft, usage, error = time.perf_counter(), None, None, None
     try:
-        encoding = tiktoken.encoding_for_model(model_name)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(string))
+        # Closed explicitly so the gateway's concurrency slot is released even if the caller stops early.
+        with closing(get_gateway().stream(client, model_name, prompt, _token_cost(model_name, prompt), rate_limiter)) as stream:
+            for chunk in stream:
+                # Groq reports token usage on the last chunk.
+                x_groq = getattr(chunk, "x_groq", None)
+                if getattr(x_groq, "usage", None) is not None:
+                    usage = x_groq.usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - started_at
+                    _record_ttft(model_name, ttft)
+                yield delta
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record_usage(model_name, usage)
+        TRACER.record("llm.stream", time.perf_counter() - stream_start, error, model=model_name,
+                      ttft_ms=round(ttft * 1000.0, 3) if ttft is not None else None,
+                      prompt_tokens=getattr(usage, "prompt_tokens", None),
+                      completion_tokens=getattr(usage, "completion_tokens", None))
+
+class IncompleteSummary(str):
+    """
+    A summary written from only part of the text: some map or merge calls failed, or
+    the partial summaries had to be cut to fit the final prompt. It reads like any
+    summary, but must not be cached; `failed_calls` counts the calls that failed.
+    """
+
+    def __new__(cls, text: str, failed_calls: int):
+        summary = super().__new__(cls, text)
+        summary.failed_calls = failed_calls
+        return summary
+
+def _prepare_summary_prompt(client, text_to_summarize: str, model_name: str, prompt_title: str,
+                            rate_limiter, max_workers: int):
+    """
+    Runs every step of the summary except the last completion.
+    Returns (prompt, stage, failed_calls) with stage "summarization" or "final summary
+    synthesis" and failed_calls the map/merge calls whose content is missing from the
+    prompt (a truncated reduce counts as one), or (None, message, failed_calls) when
+    the map phase failed entirely. Failures are noted on the current span.
+    """
+    input_budget = summary_input_budget(model_name, rate_limiter)
+    sub_chunks = split_text_by_tokens(text_to_summarize, input_budget, model_name)
+    annotate(model=model_name, parts=len(sub_chunks))
+    if len(sub_chunks) == 1:
+        return SUMMARY_PROMPT.format(title=prompt_title, text=text_to_summarize), "summarization", 0
+
+    # Map-Reduce logic for large texts
+    def summarize_part(indexed_chunk):
+        i, chunk = indexed_chunk
+        prompt = SUMMARY_PART_PROMPT.format(number=i + 1, text=chunk)
+        summary = _completion(client, model_name, prompt, rate_limiter)
+        return None if isinstance(summary, LLMErrorResult) else summary
+
+    def merge_group(group):
+        prompt = SUMMARY_MERGE_PROMPT.format(text=group)
+        merged = _completion(client, model_name, prompt, rate_limiter)
+        # On failure the group is kept unmerged, to be merged again at the next level.
+        return (group, True) if isinstance(merged, LLMErrorResult) else (merged, False)
+
+    # executor.map yields results in input order, so the parts stay in document order.
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        part_summaries = list(executor.map(summarize_part, enumerate(sub_chunks)))
+        partial_summaries = [summary for summary in part_summaries if summary]
+        failed_parts, failed_merges, truncated = len(part_summaries) - len(partial_summaries), 0, False
+
+        if not partial_summaries:
+            annotate(failed_parts=failed_parts)
+            return None, "Map-Reduce failed as all sub-chunk summaries resulted in an error.", failed_parts
+
+        # Tree reduce: merge neighbouring summaries until they fit in the final prompt.
+        combined_text = "\n\n---\n\n".join(partial_summaries)
+        for _ in range(MAX_REDUCE_LEVELS):
+            groups = split_text_by_tokens(combined_text, input_budget, model_name)
+            if len(groups) == 1:
+                break
+            merged = list(executor.map(merge_group, groups))
+            failed_merges += sum(failed for _, failed in merged)
+            combined_text = "\n\n---\n\n".join(text for text, _ in merged)
+        else:
+            groups = split_text_by_tokens(combined_text, input_budget, model_name)
+            combined_text, truncated = groups[0], len(groups) > 1
+
+    if failed_parts or failed_merges or truncated:
+        annotate(failed_parts=failed_parts, failed_merges=failed_merges, truncated=truncated)
+    return SUMMARY_FINAL_PROMPT.format(text=combined_text), "final summary synthesis", failed_parts + failed_merges + truncated
 
 #  Summarizes text using a Map-Reduce strategy.
-def get_summary(client, text_to_summarize: str, model_name: str, prompt_title: str):
+@traced("summary")
+def get_summary(client, text_to_summarize: str, model_name: str, prompt_title: str,
+                rate_limiter=None, max_workers: int = SUMMARY_MAP_WORKERS):
+    """
+    Texts larger than the model's input budget are cut into token-bounded parts that
+    are summarized concurrently (map); the partial summaries are merged level by level
+    until they fit in one prompt, then synthesized (reduce). Every call goes through
+    `rate_limiter` (a rate_limit.TokenBucket; the model's shared limiter by default).
+    Failures come back as an llm_gateway.LLMErrorResult, and a summary missing some
+    parts as an IncompleteSummary.
+    """
     if not client:
-        return "API Client is not initialized."
-    
-    MAX_TOKENS = 4000
-    if num_tokens_from_string(text_to_summarize, model_name) <= MAX_TOKENS:
-        prompt = f"Please provide a concise summary of {prompt_title}:\n\n{text_to_summarize}"
-        try:
-            response = client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}])
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"An error occurred during summarization: {e}"
+        return LLMErrorResult("API Client is not initialized.", "client", model_name)
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter(model_name)
 
-    # Map-Reduce logic for large texts
-    sub_chunks = [text_to_summarize[i:i+8000] for i in range(0, len(text_to_summarize), 8000)]
-    partial_summaries = []
-    
-    for i, chunk in enumerate(sub_chunks):
-        prompt = f"This is part {i+1} of a larger document. Please summarize just this part:\n\n{chunk}"
-        try:
-            response = client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": prompt}])
-            partial_summaries.append(response.choices[0].message.content)
-            time.sleep(2) # Respect rate limits
-        except Exception as e:
-            print(f"Error on summary chunk {i+1}: {e}. Skipping.")
-            continue
-            
-    if not partial_summaries:
-        return "Map-Reduce failed as all sub-chunk summaries resulted in an error."
+    prompt, stage, failed_calls = _prepare_summary_prompt(client, text_to_summarize, model_name, prompt_title,
+                                                          rate_limiter, max_workers)
+    if prompt is None:
+        # Every part of the map phase failed.
+        return LLMErrorResult(stage, "unavailable", model_name)
+    summary = _completion(client, model_name, prompt, rate_limiter, f"An error occurred during {stage}")
+    if failed_calls and not isinstance(summary, LLMErrorResult):
+        return IncompleteSummary(summary, failed_calls)
+    return summary
+
+class CompletionStream:
+    """
+    The text of a streamed answer or summary, for st.write_stream. A failure, even after
+    part of the text has arrived, is not mixed into the text: the stream stops and
+    `error` holds the LLMErrorResult, so callers can tell a complete result from a broken one.
+    A summary written without some of its parts sets `failed_calls`; only a stream that
+    is `complete` may be cached.
+    """
+
+    def __init__(self, pieces):
+        # `pieces` yields text, and an LLMErrorResult as its last item when it fails. An
+        # empty IncompleteSummary before the text marks it as incomplete.
+        self._pieces = pieces
+        self.error = None
+        self.failed_calls = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.error is None and not self.failed_calls
 
-    combined_text = "\n\n---\n\n".join(partial_summaries)
-    final_prompt = f"Synthesize these partial summaries into one final, comprehensive summary:\n\n{combined_text}"
+    def __iter__(self):
+        for piece in self._pieces:
+            if isinstance(piece, LLMErrorResult):
+                self.error = piece
+                return
+            if isinstance(piece, IncompleteSummary):
+                self.failed_calls = piece.failed_calls
+                continue
+            yield piece
+
+def _summary_pieces(client, text_to_summarize: str, model_name: str, prompt_title: str, rate_limiter, max_workers: int):
+    started_at = time.perf_counter()
+    if not client:
+        yield LLMErrorResult("API Client is not initialized.", "client", model_name)
+        return
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter(model_name)
+
+    prompt, stage, failed_calls = _prepare_summary_prompt(client, text_to_summarize, model_name, prompt_title,
+                                                          rate_limiter, max_workers)
+    if prompt is None:
+        yield LLMErrorResult(stage, "unavailable", model_name)
+        return
+    if failed_calls:
+        yield IncompleteSummary("", failed_calls)
     try:
-        final_response = client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": final_prompt}])
-        return final_response.choices[0].message.content
+        yield from stream_completion(client, model_name, prompt, rate_limiter, started_at)
     except Exception as e:
-        return f"An error occurred during final summary synthesis: {e}"
+        yield error_result(e, f"An error occurred during {stage}", model_name)
+
+def stream_summary(client, text_to_summarize: str, model_name: str, prompt_title: str,
+                   rate_limiter=None, max_workers: int = SUMMARY_MAP_WORKERS) -> CompletionStream:
+    """
+    Same as get_summary, but streams the last completion (the whole summary for short
+    texts, the final reduce step otherwise) as it comes in.
+    """
+    return CompletionStream(_summary_pieces(client, text_to_summarize, model_name, prompt_title, rate_limiter, max_workers))
+
+def _qa_prompt(question: str, context: str) -> str:
+    return f"""
+    Based ONLY on the context provided below, answer the user's question.
+    If the answer is not found in the context, respond with "I'm sorry, the answer could not be found in the document."
 
+    CONTEXT:\n---\n{context}\n---\nQUESTION: {question}"""
+
+def _has_enough_context(context: str) -> bool:
+    return bool(context.strip()) and len(context.strip().split()) >= 30
 
 # Generates a final answer from a pre-selected context provided by the RAG engine.
+@traced("qa.answer")
 def get_qa_answer(client, question: str, context: str, model_name: str):
    
     if not client:
-        return "API Client is not initialized."
+        return LLMErrorResult("API Client is not initialized.", "client", model_name)
     
-    if not context.strip() or len(context.strip().split()) < 30:
-       return "I'm sorry, the document does not contain enough relevant information to answer that question."
+    if not _has_enough_context(context):
+       return NOT_ENOUGH_CONTEXT_ANSWER
     
-    final_prompt = f"""
-    Based ONLY on the context provided below, answer the user's question.
-    If the answer is not found in the context, respond with "I'm sorry, the answer could not be found in the document."
+    final_prompt = _qa_prompt(question, context)
+    return _completion(client, model_name, final_prompt, error_prefix="An error occurred while generating the answer")
 
-    CONTEXT:\n---\n{context}\n---\nQUESTION: {question}"""
+def _qa_answer_pieces(client, question: str, context: str, model_name: str):
+    if not client:
+        yield LLMErrorResult("API Client is not initialized.", "client", model_name)
+        return
+    if not _has_enough_context(context):
+        yield NOT_ENOUGH_CONTEXT_ANSWER
+        return
     try:
-        response = client.chat.completions.create(model=model_name, messages=[{"role": "user", "content": final_prompt}])
-        return response.choices[0].message.content
+        yield from stream_completion(client, model_name, _qa_prompt(question, context))
     except Exception as e:
-        return f"An error occurred while generating the answer: {e}"
\ No newline at end of file
+        yield error_result(e, "An error occurred while generating the answer", model_name)
+
+def stream_qa_answer(client, question: str, context: str, model_name: str) -> CompletionStream:
+    """Same as get_qa_answer, but streams the answer as it comes in."""
+    return CompletionStream(_qa_answer_pieces(client, question, context, model_name))
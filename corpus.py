@@ -0,0 +1,198 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+
+import numpy as np
+import streamlit as st
+
+from index_bundle import BUNDLE_DIR, DEFAULT_BUNDLE_DIR, IndexBundle, read_bundle
+from ingest_cache import encode_with_cache
+from qa import CONTEXT_TOKENS, EMBEDDING_MODEL_NAME, encode_query, find_context_in_relevant_chapter, get_embedding_model, latency_stats
+from tracing import record_cache, traced
+
+# Optional list of documents to answer from; without it the corpus is the single default calendar.
+CORPUS_PATH = Path("data/corpus.json")
+DEFAULT_DOCUMENT = {
+    "id": "calendar",
+    "title": "Academic Calendar",
+    "pdf": "./data/BU.pdf",
+    "toc": "./data/toc.json",
+    "bundle": str(DEFAULT_BUNDLE_DIR),
+}
+# Run as a child process to build a document's missing or stale bundle.
+INDEX_BUNDLE_SCRIPT = Path(__file__).with_name("index_bundle.py")
+# Loaded document indexes are evicted least-recently-used beyond this estimated size.
+CORPUS_MEMORY_BUDGET_MB = float(os.environ.get("CORPUS_MEMORY_BUDGET_MB", "512"))
+
+def load_corpus_spec(corpus_path: Path = CORPUS_PATH) -> list:
+    """
+    Document specs from `corpus_path`: {"documents": [{"id", "title", "pdf", "toc",
+    optional "description" and "bundle"}]}. Bundles default to index_bundle/<id>.
+    """
+    corpus_path = Path(corpus_path)
+    if not corpus_path.exists():
+        return [dict(DEFAULT_DOCUMENT)]
+    with open(corpus_path, "r", encoding="utf-8") as f:
+        documents = json.load(f).get("documents", [])
+    if not documents:
+        raise ValueError(f"'{corpus_path}' lists no documents.")
+    specs = []
+    for document in documents:
+        spec = {"title": document["id"], "bundle": str(BUNDLE_DIR / document["id"]), **document}
+        specs.append(spec)
+    if len({spec["id"] for spec in specs}) != len(specs):
+        raise ValueError(f"'{corpus_path}' has duplicate document ids.")
+    return specs
+
+def _document_profile(spec: dict) -> str:
+    """What a document is about, for routing: its title, description and chapter titles."""
+    try:
+        with open(spec["toc"], "r", encoding="utf-8") as f:
+            chapter_titles = [item["title"] for item in json.load(f).get("chapters", [])]
+    except Exception as e:
+        print(f"Could not read the TOC of '{spec['id']}' ({e}); routing on its title and description only.")
+        chapter_titles = []
+    return "\n".join(filter(None, [spec["title"], spec.get("description", ""), "; ".join(chapter_titles)]))
+
+def _estimated_nbytes(bundle: IndexBundle) -> int:
+    """Rough resident size of a loaded bundle: its texts and vectors (memory-mapped ones included)."""
+    text_bytes = sum(len(item['text']) for item in bundle.summary_data)
+    text_bytes += sum(len(chunk) for chunk in bundle.text_chunks or [])
+    vector_bytes = getattr(bundle.chunk_embeddings, "nbytes", 0)
+    if bundle.chapter_router is not None:
+        vector_bytes += bundle.chapter_router.chapter_vectors.nbytes
+    for entry in bundle.section_index.values():
+        text_bytes += sum(len(text) for text in entry['search_texts'])
+        vector_bytes += sum(entry[field].nbytes for field in ('heading_vectors', 'search_text_vectors', 'paragraph_vectors'))
+    return text_bytes + vector_bytes
+
+class CorpusRegistry:
+    """
+    The documents the apps answer from. Each document has its own index bundle, loaded
+    on first use and evicted least-recently-used when the loaded bundles exceed
+    `memory_budget_mb`. Questions are routed to a document first, then to a chapter.
+    """
+
+    def __init__(self, documents: list, memory_budget_mb: float = CORPUS_MEMORY_BUDGET_MB, latency_window: int = 1000):
+        self.documents = OrderedDict((spec["id"], spec) for spec in documents)
+        self.memory_budget_bytes = int(memory_budget_mb * 1024 * 1024)
+        # document id -> (bundle, estimated bytes), least recently used first
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._routing_latencies = deque(maxlen=latency_window)
+        self._counters = {"loads": 0, "evictions": 0}
+        self.document_vectors = None
+        if len(self.documents) > 1:
+            profiles = [_document_profile(spec) for spec in self.documents.values()]
+            self.document_vectors = encode_with_cache(get_embedding_model(), EMBEDDING_MODEL_NAME, profiles)
+
+    @property
+    def document_ids(self) -> list:
+        return list(self.documents)
+
+    def title(self, document_id: str) -> str:
+        return self.documents[document_id]["title"]
+
+    @traced("corpus.load_document")
+    def _load(self, spec: dict) -> IndexBundle:
+        try:
+            bundle = read_bundle(spec["bundle"], spec["pdf"], spec["toc"])
+            record_cache("index_bundle", hits=int(bundle is not None), misses=int(bundle is None))
+            if bundle is None:
+                # The prebuild CLI in a child process: nothing of the build stays in this process's
+                # (never evicted) Streamlit caches, only the memory-mapped bundle it writes.
+                print(f"Building the index bundle for '{spec['id']}'; prebuild it to avoid this.")
+                subprocess.run([sys.executable, str(INDEX_BUNDLE_SCRIPT), "--pdf", spec["pdf"], "--toc", spec["toc"],
+                                "--out", spec["bundle"]], check=True)
+                bundle = read_bundle(spec["bundle"])
+            if bundle is None:
+                raise ValueError(f"no usable bundle in '{spec['bundle']}'")
+        except Exception as e:
+            print(f"Could not index '{spec['id']}': {e}")
+            return IndexBundle([], None, {}, None, None)
+        return bundle
+
+    def get(self, document_id: str) -> IndexBundle:
+        """The document's index bundle, loading it (and evicting others) if needed."""
+        with self._lock:
+            if document_id in self._loaded:
+                self._loaded.move_to_end(document_id)
+                return self._loaded[document_id][0]
+        spec = self.documents[document_id]
+        # One load at a time, so concurrent sessions asking for the same document load it once.
+        with self._load_lock:
+            with self._lock:
+                if document_id in self._loaded:
+                    self._loaded.move_to_end(document_id)
+                    return self._loaded[document_id][0]
+            bundle = self._load(spec)
+            nbytes = _estimated_nbytes(bundle)
+            with self._lock:
+                self._loaded[document_id] = (bundle, nbytes)
+                self._counters["loads"] += 1
+                # The document just loaded always stays, even if it alone exceeds the budget.
+                while len(self._loaded) > 1 and self.memory_usage_bytes() > self.memory_budget_bytes:
+                    evicted_id, _ = self._loaded.popitem(last=False)
+                    self._counters["evictions"] += 1
+                    print(f"Evicted the index of '{evicted_id}' to stay within the corpus memory budget.")
+        return bundle
+
+    def memory_usage_bytes(self) -> int:
+        return sum(nbytes for _, nbytes in self._loaded.values())
+
+    @traced("retrieve.route_document")
+    def route(self, question: str) -> str:
+        """The id of the document most similar to the question."""
+        if self.document_vectors is None:
+            return self.document_ids[0]
+        start = time.perf_counter()
+        similarities = self.document_vectors @ encode_query(question)
+        document_id = self.document_ids[int(np.argmax(similarities))]
+        with self._lock:
+            self._routing_latencies.append(time.perf_counter() - start)
+        return document_id
+
+    def find_context(self, question: str, retrieval_mode: str = "chapter", document_id: str = None,
+                     context_tokens: int = CONTEXT_TOKENS):
+        """
+        Routes the question to a document (unless `document_id` is given) and retrieves at
+        most `context_tokens` tokens of context from that document's indexes.
+        Returns (context, source, document_id) or None.
+        """
+        if document_id is None:
+            document_id = self.route(question)
+        bundle = self.get(document_id)
+        if not bundle.summary_data:
+            return None
+        context_and_source = find_context_in_relevant_chapter(
+            question, bundle.summary_data, bundle.section_index,
+            text_chunks=bundle.text_chunks, chunk_embeddings=bundle.chunk_embeddings,
+            retrieval_mode=retrieval_mode, lexical_index=bundle.lexical_index,
+            chapter_router=bundle.chapter_router, context_tokens=context_tokens
+        )
+        if context_and_source is None:
+            return None
+        return (*context_and_source, document_id)
+
+    def routing_stats(self) -> dict:
+        """Document routing and chapter routing (over the loaded documents) p50/p95 latencies."""
+        with self._lock:
+            document_samples = list(self._routing_latencies)
+            routers = [bundle.chapter_router for bundle, _ in self._loaded.values() if bundle.chapter_router is not None]
+        chapter_samples = [sample for router in routers for sample in router.latency_samples()]
+        return {"document": latency_stats(document_samples), "chapter": latency_stats(chapter_samples)}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters, documents=len(self.documents), loaded=list(self._loaded),
+                        memory_mb=self.memory_usage_bytes() / (1024 * 1024))
+
+@st.cache_resource
+def get_corpus_registry(corpus_path: str = str(CORPUS_PATH)) -> CorpusRegistry:
+    return CorpusRegistry(load_corpus_spec(corpus_path))
@@ -0,0 +1,331 @@
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+
+# "sentence-transformers" runs the full-precision torch model; "onnx-int8" runs the int8-quantized
+# ONNX export of the same model with ONNX Runtime, without importing torch.
+EMBEDDING_BACKENDS = ("sentence-transformers", "onnx-int8")
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "sentence-transformers")
+# Quantized exports published with the model; pick the one for the CPU (e.g. onnx/model_qint8_arm64.onnx).
+ONNX_MODEL_FILE = os.environ.get("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+# A local directory holding tokenizer.json and ONNX_MODEL_FILE, for deploys without Hub access.
+ONNX_MODEL_DIR = os.environ.get("EMBEDDING_ONNX_DIR")
+# all-MiniLM-L6-v2 truncates inputs at 256 word pieces.
+ONNX_MAX_SEQ_LENGTH = 256
+ONNX_BATCH_SIZE = 32
+# Every ONNX embedding must be at least this cosine-similar to the sentence-transformers one
+# for both backends to share the embedding cache and index bundles.
+COMPATIBILITY_MIN_COSINE = 0.99
+COMPATIBILITY_SAMPLE_SIZE = 200
+# Query encoding: requests from all sessions arriving within the wait window share one forward pass.
+QUERY_BATCH_MAX_SIZE = 32
+QUERY_BATCH_MAX_WAIT_MS = float(os.environ.get("QUERY_BATCH_MAX_WAIT_MS", 5))
+QUERY_CACHE_SIZE = 1024
+
+def _hub_repo_id(model_name: str) -> str:
+    # sentence-transformers resolves bare model names in its own namespace.
+    return model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+
+class SentenceTransformerBackend:
+    """The sentence-transformers model. torch and the weights are loaded on the first encode."""
+
+    name = "sentence-transformers"
+
+    def __init__(self, model_name: str, threads: int = None):
+        self.model_name = model_name
+        self.threads = threads
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+                if self.threads:
+                    import torch
+                    torch.set_num_threads(self.threads)
+                self._model = SentenceTransformer(self.model_name, device="cpu")
+            return self._model
+
+    @property
+    def dimension(self) -> int:
+        return self._load().get_sentence_embedding_dimension()
+
+    def encode(self, texts, normalize_embeddings: bool = False, batch_size: int = 32, **kwargs):
+        return self._load().encode(texts, normalize_embeddings=normalize_embeddings, batch_size=batch_size, **kwargs)
+
+class OnnxInt8Backend:
+    """
+    The int8-quantized ONNX export of the model, run with ONNX Runtime: tokenization with
+    `tokenizers`, then the same mean pooling as sentence-transformers. onnxruntime and the
+    model files are loaded on the first encode.
+    """
+
+    name = "onnx-int8"
+
+    def __init__(self, model_name: str, threads: int = None, model_file: str = ONNX_MODEL_FILE,
+                 model_dir: str = ONNX_MODEL_DIR, max_seq_length: int = ONNX_MAX_SEQ_LENGTH):
+        self.model_name = model_name
+        self.threads = threads
+        self.model_file = model_file
+        self.model_dir = model_dir
+        self.max_seq_length = max_seq_length
+        self._session = None
+        self._tokenizer = None
+        self._input_names = None
+        self._dimension = None
+        self._lock = threading.Lock()
+
+    def _paths(self):
+        if self.model_dir:
+            return Path(self.model_dir) / self.model_file, Path(self.model_dir) / "tokenizer.json"
+        from huggingface_hub import hf_hub_download
+        repo_id = _hub_repo_id(self.model_name)
+        return hf_hub_download(repo_id, self.model_file), hf_hub_download(repo_id, "tokenizer.json")
+
+    def _load(self):
+        with self._lock:
+            if self._session is None:
+                import onnxruntime
+                from tokenizers import Tokenizer
+                model_path, tokenizer_path = self._paths()
+                tokenizer = Tokenizer.from_file(str(tokenizer_path))
+                tokenizer.enable_truncation(max_length=self.max_seq_length)
+                tokenizer.enable_padding(pad_id=tokenizer.token_to_id("[PAD]") or 0, pad_token="[PAD]")
+                options = onnxruntime.SessionOptions()
+                if self.threads:
+                    options.intra_op_num_threads = self.threads
+                session = onnxruntime.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+                self._input_names = {model_input.name for model_input in session.get_inputs()}
+                self._tokenizer, self._session = tokenizer, session
+            return self._session, self._tokenizer
+
+    def _encode_batch(self, texts: list) -> np.ndarray:
+        session, tokenizer = self._load()
+        encodings = tokenizer.encode_batch(texts)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        hidden = session.run(None, {name: value for name, value in inputs.items() if name in self._input_names})[0]
+        # Mean over the real (unpadded) tokens.
+        mask = attention_mask[..., None].astype(np.float32)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    @property
+    def dimension(self) -> int:
+        if self._dimension is None:
+            session, _ = self._load()
+            # Output 0 is the token embeddings, [batch, tokens, dimension]; exports may leave the size symbolic.
+            size = session.get_outputs()[0].shape[-1]
+            self._dimension = size if isinstance(size, int) else self._encode_batch(["dimension"]).shape[1]
+        return self._dimension
+
+    def encode(self, texts, normalize_embeddings: bool = False, batch_size: int = ONNX_BATCH_SIZE, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        # Longest first, so each batch pads to similar lengths; the input order is restored below.
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        batches = [self._encode_batch([texts[i] for i in order[start:start + batch_size]])
+                   for start in range(0, len(texts), batch_size)]
+        vectors = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+        vectors[order] = np.vstack(batches)
+        if normalize_embeddings:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors[0] if single else vectors
+
+class EmbeddingBatcher:
+    """
+    Process-wide query encoder. Callers on any thread block in encode() while one worker
+    thread collects the queued texts for up to `max_wait_ms` (or `max_batch_size` texts)
+    and encodes them in a single call. A lone text on an idle encoder is encoded at once,
+    so single users pay no wait. Results are kept in an LRU cache, and a text that is
+    already queued is not queued again.
+    """
+
+    def __init__(self, model, max_batch_size: int = QUERY_BATCH_MAX_SIZE, max_wait_ms: float = QUERY_BATCH_MAX_WAIT_MS,
+                 cache_size: int = QUERY_CACHE_SIZE, on_batch=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.cache_size = cache_size
+        # Called from the worker as on_batch(size, seconds) after every batch, e.g. for tracing.
+        self.on_batch = on_batch
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._last_batch_size = 0
+        self._batches = 0
+        self._encoded = 0
+        self._hits = 0
+        self._misses = 0
+
+    def _ensure_worker(self):
+        # Restarted if it ever died, so queued texts are never left without a worker.
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, daemon=True, name="embedding-batcher")
+            self._worker.start()
+
+    def submit(self, text: str) -> Future:
+        """A future for the unit-normalized embedding of `text`; already resolved on a cache hit."""
+        with self._lock:
+            if text in self._cache:
+                self._cache.move_to_end(text)
+                self._hits += 1
+                future = Future()
+                future.set_result(self._cache[text])
+                return future
+            self._misses += 1
+            if text in self._pending:
+                return self._pending[text]
+            future = self._pending[text] = Future()
+            self._ensure_worker()
+        self._queue.put(text)
+        return future
+
+    def encode(self, text: str) -> np.ndarray:
+        """Read-only embedding of one text; blocks until its batch is encoded."""
+        return self.submit(text).result()
+
+    def _next_batch(self) -> list:
+        batch = [self._queue.get()]
+        # Under load (texts already waiting, or the last batch had company) wait for more.
+        if self._queue.empty() and self._last_batch_size <= 1:
+            return batch
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            start = time.perf_counter()
+            try:
+                vectors = np.asarray(self.model.encode(batch, normalize_embeddings=True, batch_size=len(batch)),
+                                     dtype=np.float32)
+            except Exception as e:
+                with self._lock:
+                    futures = [self._pending.pop(text) for text in batch]
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            seconds = time.perf_counter() - start
+            with self._lock:
+                futures = []
+                for text, row in zip(batch, vectors):
+                    vector = np.array(row)
+                    vector.flags.writeable = False
+                    self._cache[text] = vector
+                    futures.append((self._pending.pop(text), vector))
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+                self._last_batch_size = len(batch)
+                self._batches += 1
+                self._encoded += len(batch)
+            for future, vector in futures:
+                future.set_result(vector)
+            if self.on_batch is not None:
+                try:
+                    self.on_batch(len(batch), seconds)
+                except Exception as e:
+                    print(f"Embedding batch callback failed: {e}")
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {"batches": self._batches, "encoded": self._encoded,
+                    "mean_batch_size": self._encoded / self._batches if self._batches else 0.0,
+                    "cache_hits": self._hits, "cache_misses": self._misses,
+                    "cache_hit_rate": self._hits / lookups if lookups else 0.0}
+
+def create_embedding_backend(model_name: str, backend: str = EMBEDDING_BACKEND, threads: int = None):
+    """An embedding model with the sentence-transformers `encode` signature; nothing heavy is loaded until it is used."""
+    if backend == "sentence-transformers":
+        return SentenceTransformerBackend(model_name, threads)
+    if backend == "onnx-int8":
+        return OnnxInt8Backend(model_name, threads)
+    raise ValueError(f"Unknown embedding backend '{backend}'; expected one of {', '.join(EMBEDDING_BACKENDS)}.")
+
+def compatibility_report(reference, candidate, texts: list) -> dict:
+    """Per-text cosine similarity between two backends' normalized embeddings, with load and encode timings."""
+    report = {}
+    vectors = {}
+    for label, backend in (("reference", reference), ("candidate", candidate)):
+        start = time.perf_counter()
+        backend.encode(texts[:1], normalize_embeddings=True)
+        loaded = time.perf_counter()
+        vectors[label] = np.asarray(backend.encode(texts, normalize_embeddings=True), dtype=np.float32)
+        encoded = time.perf_counter()
+        report[label] = {"backend": backend.name, "load_s": round(loaded - start, 3),
+                         "texts_per_s": round(len(texts) / max(encoded - loaded, 1e-9), 1)}
+    if vectors["reference"].shape != vectors["candidate"].shape:
+        raise ValueError(f"Embedding shapes differ: {report['reference']['backend']} {vectors['reference'].shape}, "
+                         f"{report['candidate']['backend']} {vectors['candidate'].shape}.")
+    cosines = np.sum(vectors["reference"] * vectors["candidate"], axis=1)
+    report.update(texts=len(texts), min_cosine=float(cosines.min()), mean_cosine=float(cosines.mean()))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that an embedding backend matches sentence-transformers closely enough to share its indexes.")
+    parser.add_argument("--pdf", default="./data/BU.pdf")
+    parser.add_argument("--toc", default="./data/toc.json")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, choices=EMBEDDING_BACKENDS,
+                        help="Backend to check (default: EMBEDDING_BACKEND).")
+    parser.add_argument("--samples", type=int, default=COMPATIBILITY_SAMPLE_SIZE)
+    parser.add_argument("--min-cosine", type=float, default=COMPATIBILITY_MIN_COSINE)
+    args = parser.parse_args()
+    if args.backend == "sentence-transformers":
+        # The reference itself; run in the Render build, so only a configured ONNX backend is checked.
+        print("sentence-transformers is the reference backend; nothing to check.")
+        return
+
+    from index_bundle import load_index_bundle
+    from qa import EMBEDDING_MODEL_NAME
+    indexes = load_index_bundle(args.pdf, args.toc)
+    # Evenly spaced document chunks plus the chapter titles, which are short like questions.
+    step = max(1, len(indexes.text_chunks) // args.samples)
+    texts = list(indexes.text_chunks[::step][:args.samples]) + [item['title'] for item in indexes.summary_data]
+
+    try:
+        report = compatibility_report(create_embedding_backend(EMBEDDING_MODEL_NAME, "sentence-transformers"),
+                                      create_embedding_backend(EMBEDDING_MODEL_NAME, args.backend), texts)
+    except ValueError as e:
+        print(f"'{args.backend}' embeddings are not compatible with the existing indexes: {e}")
+        sys.exit(1)
+    for label in ("reference", "candidate"):
+        print(f"{report[label]['backend']:<22} load {report[label]['load_s']:>7.2f} s  "
+              f"{report[label]['texts_per_s']:>8.1f} texts/s")
+    print(f"{report['texts']} texts: min cosine {report['min_cosine']:.5f}, mean {report['mean_cosine']:.5f} "
+          f"(required: {args.min_cosine}).")
+    if report["min_cosine"] < args.min_cosine:
+        print(f"'{args.backend}' embeddings are not compatible with the existing indexes.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,31 @@
 import streamlit as st
+import contextvars
 import itertools
-import pandas as pd
 import requests
-import time
-from datetime import datetime
-from pathlib import Path
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
+import numpy as np
 
 
-from chat import get_summary, get_qa_answer
+from chat import get_summary, get_qa_answer, theme_prompt_title
+from eval_log import log_evaluation
+from llm_gateway import LLMCallError, LLMErrorResult, get_gateway
+from qa import get_embedding_model
+from rate_limit import get_rate_limiter
+from tracing import annotate, traced
 
+# "local" scores similarity with the shared MiniLM model; "api" uses the API Ninjas service.
+SIMILARITY_BACKEND = os.environ.get("SIMILARITY_BACKEND", "local")
+# The API Ninjas quota; calls are paced and retried by the LLM gateway like the Groq ones.
+SIMILARITY_API_NAME = "api-ninjas"
+SIMILARITY_API_REQUESTS_PER_MINUTE = int(os.environ.get("SIMILARITY_API_REQUESTS_PER_MINUTE", 50))
+SIMILARITY_API_TIMEOUT = 30
+# The local model reads at most 256 word pieces; longer outputs are embedded in windows of this many words.
+SIMILARITY_WINDOW_WORDS = 150
+
+@traced("similarity.api")
 def get_similarity_score(text1: str, text2: str) -> float:
     """Calculates semantic similarity using the API Ninjas service."""
     try:
@@ -21,99 +38,233 @@ def get_similarity_score(text1: str, text2: str) -> float:
     headers = {'X-Api-Key': api_key}
     body = {'text_1': text1[:4900], 'text_2': text2[:4900]}
     
-    try:
-        response = requests.post(api_url, headers=headers, json=body)
+    def post():
+        response = requests.post(api_url, headers=headers, json=body, timeout=SIMILARITY_API_TIMEOUT)
         response.raise_for_status()
         return response.json().get('similarity', 0.0)
-    except requests.exceptions.RequestException:
+
+    rate_limiter = get_rate_limiter(SIMILARITY_API_NAME, SIMILARITY_API_REQUESTS_PER_MINUTE)
+    try:
+        return get_gateway().call(SIMILARITY_API_NAME, post, rate_limiter)
+    except LLMCallError:
         return 0.0
 
-def run_consensus_evaluation(client, models: list, task_type, context, prompt):
+# Seconds to wait for the slowest model before continuing with the answers that arrived.
+MODEL_CALL_TIMEOUT = 60
+
+# "cascade" asks the models cheapest first and stops once two answers agree; "full" asks all of them at once.
+CONSENSUS_MODES = ("full", "cascade")
+CONSENSUS_MODE = os.environ.get("CONSENSUS_MODE", "full")
+# Cheapest and fastest first.
+CASCADE_MODEL_ORDER = ["llama3-8b-8192", "gemma2-9b-it", "llama3-70b-8192"]
+# Two answers at least this similar (embedding cosine, or the API Ninjas score) settle the cascade.
+CASCADE_AGREEMENT_THRESHOLD = float(os.environ.get("CASCADE_AGREEMENT_THRESHOLD", 0.85))
+# Call budget per cascaded run: after this many models without agreement, the closest answer wins. Unset: all models.
+CASCADE_MAX_CALLS = int(os.environ["CASCADE_MAX_CALLS"]) if os.environ.get("CASCADE_MAX_CALLS") else None
+# Cascaded runs per (resolution, stage), for the Performance panel.
+_cascade_resolutions = defaultdict(int)
+_cascade_lock = threading.Lock()
+
+def _run_model(client, model, task_type, context, prompt):
+    if task_type == 'qa':
+        return get_qa_answer(client, prompt, context, model)
+    elif task_type == 'summary':
+        return get_summary(client, context, model, theme_prompt_title(prompt))
+    return LLMErrorResult(f"An error occurred: unknown task type '{task_type}'.", "client", model)
+
+@traced("consensus.collect")
+def collect_model_results(client, models: list, task_type, context, prompt, timeout=MODEL_CALL_TIMEOUT):
     """
-    If multiple models are provided, runs a full consensus evaluation.
-    If only one model is provided, it runs that single model and returns early.
+    Calls every model concurrently and waits at most `timeout` seconds overall.
+    Models that raise or do not finish in time get an LLMErrorResult, so the
+    caller works with the partial results instead of waiting for the slowest call.
     """
-    
-    # --- Step 1: Get result(s) from all provided models ---
+    annotate(models=len(models), task_type=task_type)
+    executor = ThreadPoolExecutor(max_workers=max(1, len(models)))
+    # Each call runs in a copy of the caller's context, so its spans are children of this one.
+    futures = {executor.submit(contextvars.copy_context().run, _run_model, client, model, task_type, context, prompt): model
+               for model in models}
+    done, _ = wait(futures, timeout=timeout)
+
     results = {}
-    for model in models:
-        if task_type == 'qa':
-            result = get_qa_answer(client, prompt, context, model)
-        elif task_type == 'summary':
-            result = get_summary(client, context, model, f"the theme '{prompt}'")
-        results[model] = result
-        time.sleep(1)
+    for future, model in futures.items():
+        if future not in done:
+            results[model] = LLMErrorResult(f"An error occurred: {model} did not respond within {timeout} s.",
+                                            "timeout", model)
+            continue
+        try:
+            results[model] = future.result()
+        except Exception as e:
+            results[model] = LLMErrorResult(f"An error occurred with {model}: {e}", "client", model)
+    # Don't block on calls that timed out; their results are discarded.
+    executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+def _word_windows(text: str, window_words: int = SIMILARITY_WINDOW_WORDS) -> list:
+    words = text.split()
+    return [" ".join(words[i:i + window_words]) for i in range(0, len(words), window_words)] or [text]
+
+@traced("similarity.local")
+def get_similarity_matrix(texts: list) -> np.ndarray:
+    """
+    Pairwise cosine similarities of all texts, from one batched encode with the already
+    loaded embedding model and one matrix product. The model truncates at 256 word pieces,
+    so each text is cut into windows of SIMILARITY_WINDOW_WORDS words and represented by
+    the mean of its windows' normalized vectors.
+    """
+    windows = [_word_windows(text) for text in texts]
+    flat = [window for text_windows in windows for window in text_windows]
+    window_vectors = np.asarray(get_embedding_model().encode(flat, normalize_embeddings=True), dtype=np.float32)
+    owners = np.repeat(np.arange(len(texts)), [len(text_windows) for text_windows in windows])
+    vectors = np.zeros((len(texts), window_vectors.shape[1]), dtype=np.float32)
+    np.add.at(vectors, owners, window_vectors)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors @ vectors.T
+
+def _pairwise_scores(valid_results: dict) -> dict:
+    """Similarity score for every pair of model outputs, keyed by (model1, model2)."""
+    models = list(valid_results.keys())
+    if SIMILARITY_BACKEND == "local":
+        matrix = get_similarity_matrix([valid_results[m] for m in models])
+        return {(models[i], models[j]): float(matrix[i, j]) for i, j in itertools.combinations(range(len(models)), 2)}
+
+    # The gateway paces these calls to the API's quota.
+    return {(m1, m2): get_similarity_score(valid_results[m1], valid_results[m2])
+            for m1, m2 in itertools.combinations(models, 2)}
+
+def log_single_model_result(task_type, model, best_result):
+    """
+    Queues the record of a single-model run (also used by the streaming UI path) for the
+    evaluation log; an LLMErrorResult is logged as a failed run.
+    """
+    if isinstance(best_result, LLMErrorResult):
+        log_evaluation({"kind": "error", "task_type": task_type, "model": model, "error": best_result,
+                        "error_kind": best_result.kind})
+        return
+    log_evaluation({"kind": "single", "task_type": task_type, "model": model, "result": best_result})
+
+def _agreement_scores(valid_results: dict, scores: dict) -> dict:
+    """Each model's mean similarity to the other answers, over the pairs that were scored."""
+    avg_scores = {}
+    for model in valid_results:
+        model_scores = [score for pair, score in scores.items() if model in pair]
+        avg_scores[model] = sum(model_scores) / len(model_scores) if model_scores else 0.0
+    return avg_scores
+
+def log_consensus_result(task_type, prompt, models: list, results: dict, scores: dict, avg_scores: dict,
+                         best_model_name: str, resolution: str):
+    """Queues the record of a multi-model run; `python eval_log.py` renders its report and similarity matrix."""
+    log_evaluation({
+        "kind": "consensus", "task_type": task_type, "prompt": prompt, "models": list(models),
+        "results": results, "scores": [[m1, m2, score] for (m1, m2), score in scores.items()],
+        "avg_scores": avg_scores, "best_model": best_model_name, "resolution": resolution,
+    })
+
+def cascade_order(models: list) -> list:
+    """`models` cheapest first per CASCADE_MODEL_ORDER; unlisted models go last, in the given order."""
+    rank = {model: i for i, model in enumerate(CASCADE_MODEL_ORDER)}
+    return sorted(models, key=lambda model: rank.get(model, len(rank)))
+
+def _similarities_to(answer: str, earlier_results: dict) -> dict:
+    """Similarity of `answer` to each earlier answer, keyed by the earlier model."""
+    earlier_models = list(earlier_results)
+    if SIMILARITY_BACKEND == "local":
+        matrix = get_similarity_matrix([answer] + [earlier_results[m] for m in earlier_models])
+        return {model: float(matrix[0, i + 1]) for i, model in enumerate(earlier_models)}
+    return {model: get_similarity_score(answer, earlier_results[model]) for model in earlier_models}
+
+def _record_cascade_stage(resolution: str, stage: int):
+    with _cascade_lock:
+        _cascade_resolutions[(resolution, stage)] += 1
+
+def cascade_stats() -> list:
+    """How many cascaded runs ended at each stage, and how: rows of resolution, stage (models called), runs."""
+    with _cascade_lock:
+        counts = dict(_cascade_resolutions)
+    return [{"resolution": resolution, "stage": stage, "runs": runs}
+            for (resolution, stage), runs in sorted(counts.items(), key=lambda item: (item[0][1], item[0][0]))]
+
+@traced("consensus.cascade")
+def run_cascade_evaluation(client, models: list, task_type, context, prompt, timeout=MODEL_CALL_TIMEOUT,
+                           threshold=CASCADE_AGREEMENT_THRESHOLD, max_calls=CASCADE_MAX_CALLS):
+    """
+    Asks the models one at a time, cheapest first, and stops as soon as the new answer
+    agrees (similarity >= `threshold`) with an earlier one; the answer of the later, larger
+    model of the pair is returned. Failed calls are skipped. When `max_calls` models (all of
+    them by default) have answered without agreement, the answer closest to the others wins,
+    as in the full consensus. The returned dict says which stage resolved the run and how.
+    """
+    ordered = cascade_order(models)[:max_calls or len(models)]
+    results, valid_results, scores = {}, {}, {}
+    best_model_name, resolution = None, "exhausted"
+    for model in ordered:
+        answer = collect_model_results(client, [model], task_type, context, prompt, timeout)[model]
+        results[model] = answer
+        if isinstance(answer, LLMErrorResult):
+            continue
+        if valid_results:
+            similarities = _similarities_to(answer, valid_results)
+            scores.update({(earlier, model): score for earlier, score in similarities.items()})
+            if max(similarities.values()) >= threshold:
+                valid_results[model] = answer
+                best_model_name, resolution = model, "agreement"
+                break
+        valid_results[model] = answer
+
+    stage = len(results)
+    avg_scores = _agreement_scores(valid_results, scores)
+    if best_model_name is None and valid_results:
+        best_model_name = max(avg_scores, key=avg_scores.get)
+    _record_cascade_stage(resolution, stage)
+    annotate(stage=stage, resolution=resolution, models_called=list(results))
+    if best_model_name is None:
+        return {"best_result": "Could not generate a valid answer.", "stage": stage, "resolution": resolution}
+
+    log_consensus_result(task_type, prompt, list(results), results, scores, avg_scores, best_model_name,
+                         f"cascade, {resolution} after {stage} of {len(ordered)} model(s): {', '.join(results)}")
+    return {"best_result": results[best_model_name], "stage": stage, "resolution": resolution}
+
+@traced("consensus")
+def run_consensus_evaluation(client, models: list, task_type, context, prompt, timeout=MODEL_CALL_TIMEOUT,
+                             mode=CONSENSUS_MODE, max_calls=CASCADE_MAX_CALLS):
+    """
+    If multiple models are provided, runs a consensus evaluation: "full" asks every model
+    at once and scores all pairs, "cascade" (see run_cascade_evaluation) adds models only
+    until two answers agree or `max_calls` models have answered.
+    If only one model is provided, it runs that single model and returns early.
+    """
+    if mode not in CONSENSUS_MODES:
+        raise ValueError(f"Unknown consensus mode '{mode}'. Expected one of {CONSENSUS_MODES}.")
 
     # --- Case 1: Single Model (for fast summarization) ---
     if len(models) == 1:
+        results = collect_model_results(client, models, task_type, context, prompt, timeout)
         best_result = next(iter(results.values()), "No result generated.")
-        
-        # Create a simple log for the single-model run
-        log_dir = Path("logs")
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        report_filename = log_dir / f"report_{task_type}_{timestamp}.txt"
-        report_content = f"--- Single Model Report ---\n"
-        report_content += f"Timestamp: {timestamp}\nTask Type: {task_type.upper()}\nModel: {models[0]}\n\n"
-        report_content += f"--- RESULT ---\n{best_result}\n"
-        with open(report_filename, "w", encoding="utf-8") as f:
-            f.write(report_content)
-            
-        print(f"Single model evaluation complete. Report saved.")
+        log_single_model_result(task_type, models[0], best_result)
         
         # Return immediately.
         return {"best_result": best_result}
+
+    # --- Case 2: Multiple Models, cheapest first until two agree ---
+    if mode == "cascade":
+        return run_cascade_evaluation(client, models, task_type, context, prompt, timeout, max_calls=max_calls)
+
+    # --- Case 3: Multiple Models, all at once (for robust Q&A) ---
+    results = collect_model_results(client, models, task_type, context, prompt, timeout)
+    valid_results = {m: r for m, r in results.items() if isinstance(r, str) and not isinstance(r, LLMErrorResult)}
     
-    # --- Case 2: Multiple Models (for robust Q&A) ---
-    else:
-        scores = {}
-        valid_results = {m: r for m, r in results.items() if isinstance(r, str) and not r.startswith("An error")}
-        
-        if len(valid_results) < 2:
-            return {"best_result": next(iter(valid_results.values()), "Could not generate a valid answer.")}
+    if len(valid_results) < 2:
+        return {"best_result": next(iter(valid_results.values()), "Could not generate a valid answer.")}
 
-        for m1, m2 in itertools.combinations(valid_results.keys(), 2):
-            score = get_similarity_score(valid_results[m1], valid_results[m2])
-            scores[(m1, m2)] = score
-            time.sleep(1.1)
+    scores = _pairwise_scores(valid_results)
 
-        if not scores:
-            return {"best_result": next(iter(valid_results.values()))}
+    if not scores:
+        return {"best_result": next(iter(valid_results.values()))}
 
-        avg_scores = {model: sum(s for p, s in scores.items() if model in p) / (len(valid_results) - 1) for model in valid_results.keys()}
-        best_model_name = max(avg_scores, key=avg_scores.get)
-        best_result = results[best_model_name]
-
-        sim_matrix = pd.DataFrame(index=models, columns=models, dtype=float)
-        for (m1, m2), score in scores.items():
-            sim_matrix.loc[m1, m2] = score
-            sim_matrix.loc[m2, m1] = score
-        for model in models:
-            sim_matrix.loc[model, model] = 1.0
-        matrix_string = sim_matrix.to_string(float_format="%.4f")
-
-        # --- Logging is now INSIDE the else block ---
-        log_dir = Path("logs")
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        report_filename = log_dir / f"report_{task_type}_{timestamp}.txt"
-        
-        report_content = f"--- Consensus Evaluation Report ---\n"
-        report_content += f"Timestamp: {timestamp}\nTask Type: {task_type.upper()}\nPrompt/Theme: {prompt}\n\n"
-        report_content += f"--- BEST RESULT (from {best_model_name}) ---\n{best_result}\n\n"
-        report_content += f"--- Consensus Scores ---\n"
-        for model, score in sorted(avg_scores.items(), key=lambda item: item[1], reverse=True):
-            report_content += f"- {model}: {score:.4f}\n"
-        report_content += f"\n--- Pairwise Similarity Matrix ---\n{matrix_string}\n"
-        report_content += f"\n--- All Model Outputs ---\n"
-        for model, output in results.items():
-            report_content += f"\n--- Output from {model} ---\n{output}\n"
-
-        with open(report_filename, "w", encoding="utf-8") as f:
-            f.write(report_content)
-        
+    avg_scores = _agreement_scores(valid_results, scores)
+    best_model_name = max(avg_scores, key=avg_scores.get)
+    log_consensus_result(task_type, prompt, models, results, scores, avg_scores, best_model_name,
+                         f"full, {len(models)} model(s)")
 
-        matrix_html_filename = log_dir / f"matrix_{task_type}_{timestamp}.html"
-        sim_matrix.to_html(matrix_html_filename)
-        print(f"Consensus evaluation complete. Report saved.")
-        
-        # Return the best result for the multi-model case
-        return {"best_result": best_result}
\ No newline at end of file
+    # Return the best result for the multi-model case
+    return {"best_result": results[best_model_name], "stage": len(models), "resolution": "full"}
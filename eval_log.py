@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from tracing import JsonlSink
+
+# Append-only evaluation log: one JSON object per model run, rotated by size.
+EVAL_LOG_PATH = Path(os.environ.get("EVAL_LOG_PATH", "logs/evaluations.jsonl"))
+EVAL_LOG_MAX_BYTES = int(os.environ.get("EVAL_LOG_MAX_BYTES", 10 * 1024 * 1024))
+# Rotated files kept as evaluations.jsonl.1 (newest) ... .N (oldest).
+EVAL_LOG_BACKUPS = 5
+# Records waiting for the writer; beyond this they are dropped rather than blocking a request.
+EVAL_LOG_QUEUE_SIZE = 1000
+REPORT_DIR = Path("reports")
+
+# Written by a background thread (see tracing.JsonlSink), so logging adds no latency to requests.
+EVAL_LOG = JsonlSink(EVAL_LOG_PATH, EVAL_LOG_MAX_BYTES, EVAL_LOG_BACKUPS, EVAL_LOG_QUEUE_SIZE, "evaluation log")
+
+def log_evaluation(record: dict) -> bool:
+    """Queues `record`, stamped with the current UTC time; False if it was dropped."""
+    return EVAL_LOG.log({"ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), **record})
+
+def read_records(path: Path = EVAL_LOG_PATH) -> list:
+    """All records of the log and its rotated files, oldest first."""
+    path = Path(path)
+    rotated = [p for p in path.parent.glob(f"{path.name}.*") if p.suffix[1:].isdigit()]
+    files = sorted(rotated, key=lambda p: -int(p.suffix[1:]))
+    records = []
+    for log_file in [*files, path]:
+        if not log_file.exists():
+            continue
+        with open(log_file, "r", encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+def render_report(record: dict):
+    """
+    The text report of a record ("single", "error" or "consensus") and, for a consensus
+    run, its similarity matrix as HTML (else None).
+    """
+    if record["kind"] == "single":
+        report_content = "--- Single Model Report ---\n"
+        report_content += f"Timestamp: {record['ts']}\nTask Type: {record['task_type'].upper()}\nModel: {record['model']}\n\n"
+        report_content += f"--- RESULT ---\n{record['result']}\n"
+        return report_content, None
+    if record["kind"] == "error":
+        report_content = "--- Failed Run Report ---\n"
+        report_content += f"Timestamp: {record['ts']}\nTask Type: {record['task_type'].upper()}\nModel: {record['model']}\n\n"
+        report_content += f"--- ERROR ({record['error_kind']}) ---\n{record['error']}\n"
+        return report_content, None
+
+    import pandas as pd
+    models = record["models"]
+    sim_matrix = pd.DataFrame(index=models, columns=models, dtype=float)
+    for m1, m2, score in record["scores"]:
+        sim_matrix.loc[m1, m2] = score
+        sim_matrix.loc[m2, m1] = score
+    for model in models:
+        sim_matrix.loc[model, model] = 1.0
+
+    report_content = "--- Consensus Evaluation Report ---\n"
+    report_content += f"Timestamp: {record['ts']}\nTask Type: {record['task_type'].upper()}\nPrompt/Theme: {record['prompt']}\n"
+    report_content += f"Resolution: {record['resolution']}\n\n"
+    report_content += f"--- BEST RESULT (from {record['best_model']}) ---\n{record['results'][record['best_model']]}\n\n"
+    report_content += "--- Consensus Scores ---\n"
+    for model, score in sorted(record["avg_scores"].items(), key=lambda item: item[1], reverse=True):
+        report_content += f"- {model}: {score:.4f}\n"
+    report_content += f"\n--- Pairwise Similarity Matrix ---\n{sim_matrix.to_string(float_format='%.4f')}\n"
+    report_content += "\n--- All Model Outputs ---\n"
+    for model, output in record["results"].items():
+        report_content += f"\n--- Output from {model} ---\n{output}\n"
+    return report_content, sim_matrix.to_html()
+
+def main():
+    parser = argparse.ArgumentParser(description="Render text reports and similarity matrices from the evaluation log.")
+    parser.add_argument("--log", default=str(EVAL_LOG_PATH))
+    parser.add_argument("--out", default=str(REPORT_DIR))
+    parser.add_argument("--last", type=int, help="Only the most recent N records.")
+    parser.add_argument("--task", choices=["qa", "summary"])
+    args = parser.parse_args()
+
+    records = [record for record in read_records(args.log) if args.task in (None, record.get("task_type"))]
+    if args.last:
+        records = records[-args.last:]
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for i, record in enumerate(records):
+        stamp = datetime.fromisoformat(record["ts"]).strftime("%Y%m%d_%H%M%S")
+        name = f"{record['task_type']}_{stamp}_{i:04d}"
+        report_content, matrix_html = render_report(record)
+        with open(out_dir / f"report_{name}.txt", "w", encoding="utf-8") as f:
+            f.write(report_content)
+        if matrix_html is not None:
+            with open(out_dir / f"matrix_{name}.html", "w", encoding="utf-8") as f:
+                f.write(matrix_html)
+    print(f"Rendered {len(records)} report(s) to '{out_dir}'.")
+
+if __name__ == "__main__":
+    main()
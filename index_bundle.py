@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import streamlit as st
+
+from chat import num_tokens_from_string
+from ingest_cache import INGEST_WORKERS
+from qa import (EMBEDDING_MODEL_NAME, ChapterRouter, LexicalIndex, build_section_index, create_document_index,
+                get_chapter_router, get_embedding_model, get_section_index)
+from summarizer_engine import extract_pages, load_chapter_sections, load_summary_data
+
+# Written by `python index_bundle.py` (e.g. in the Render buildCommand), loaded read-only by the apps.
+BUNDLE_DIR = Path("index_bundle")
+# Every document's bundle is BUNDLE_DIR/<document id>; this one is the default calendar's.
+DEFAULT_BUNDLE_DIR = BUNDLE_DIR / "calendar"
+# Bump when the files or their layout change; older bundles are then ignored.
+BUNDLE_FORMAT_VERSION = 1
+SECTION_FIELDS = (('headings', 'heading_vectors'), ('search_texts', 'search_text_vectors'),
+                  ('paragraphs', 'paragraph_vectors'))
+
+def _sha256_file(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _bundle_version(pdf_sha256: str, toc_sha256: str, model_name: str) -> str:
+    key = f"{pdf_sha256}:{toc_sha256}:{model_name}:{BUNDLE_FORMAT_VERSION}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+class IndexBundle:
+    """Everything the apps retrieve from: chapters, router, section index and chunk index."""
+
+    def __init__(self, summary_data: list, chapter_router: ChapterRouter, section_index: dict,
+                 text_chunks: list, chunk_embeddings: np.ndarray, manifest: dict = None):
+        self.summary_data = summary_data
+        self.chapter_router = chapter_router
+        self.section_index = section_index
+        self.text_chunks = text_chunks
+        self.chunk_embeddings = chunk_embeddings
+        self.manifest = manifest
+        self._lexical_index = None
+
+    @property
+    def lexical_index(self) -> LexicalIndex:
+        if self._lexical_index is None and self.text_chunks is not None:
+            self._lexical_index = LexicalIndex(self.text_chunks, self.chunk_embeddings, self.section_index)
+        return self._lexical_index
+
+def _write_json(path: Path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+def build_bundle(pdf_path: str, toc_path: str, out_dir: Path = DEFAULT_BUNDLE_DIR, workers: int = None) -> dict:
+    """
+    Runs the whole ingestion pipeline once and writes the bundle. Returns its manifest.
+    Page extraction and embedding use `workers` processes (default INGEST_WORKERS).
+    """
+    workers = INGEST_WORKERS if workers is None else workers
+    timings = {}
+    def timed(stage, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings[stage] = round(time.perf_counter() - start, 3)
+        return result
+
+    # Extracting first lets every later stage read the pages from the shared cache.
+    pages = timed("pages", extract_pages, pdf_path, workers)
+    summary_data = timed("chapters", load_summary_data, pdf_path, toc_path)
+    if not summary_data:
+        raise SystemExit(f"No chapters could be loaded from '{pdf_path}' and '{toc_path}'.")
+    chapter_sections = timed("sections", load_chapter_sections, pdf_path, toc_path)
+    text_chunks, chunk_embeddings = timed("chunks", create_document_index, pdf_path, workers)
+    if text_chunks is None:
+        raise SystemExit(f"No text chunks could be extracted from '{pdf_path}'.")
+    model = get_embedding_model()
+    chapter_router = timed("chapter_vectors", ChapterRouter.from_summary_data, summary_data, model)
+    section_index = timed("section_vectors", build_section_index, summary_data, chapter_sections, model, workers)
+
+    start = time.perf_counter()
+    chapters = [
+        {"title": item['title'], "text": item['text'], "tokens": num_tokens_from_string(item['text'])}
+        for item in summary_data
+    ]
+    sections = {
+        title: {
+            **{field: entry[field] for field, _ in SECTION_FIELDS},
+            "search_text_tokens": [num_tokens_from_string(text) for text in entry['search_texts']],
+        }
+        for title, entry in section_index.items()
+    }
+    chunks = [{"text": chunk, "tokens": num_tokens_from_string(chunk)} for chunk in text_chunks]
+    timings["token_counts"] = round(time.perf_counter() - start, 3)
+
+    pdf_sha256, toc_sha256 = _sha256_file(pdf_path), _sha256_file(toc_path)
+    out_dir = Path(out_dir)
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.tmp{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    _write_json(tmp_dir / "chapters.json", chapters)
+    _write_json(tmp_dir / "sections.json", sections)
+    _write_json(tmp_dir / "chunks.json", chunks)
+    np.save(tmp_dir / "chapter_vectors.npy", chapter_router.chapter_vectors)
+    np.save(tmp_dir / "chunk_embeddings.npy", np.ascontiguousarray(chunk_embeddings, dtype=np.float32))
+    for _, vector_field in SECTION_FIELDS:
+        np.save(tmp_dir / f"{vector_field}.npy", np.vstack([entry[vector_field] for entry in section_index.values()]))
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "bundle_version": _bundle_version(pdf_sha256, toc_sha256, EMBEDDING_MODEL_NAME),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        # Informational: backends within embedding_backend.COMPATIBILITY_MIN_COSINE share bundles.
+        "embedding_backend": getattr(model, "name", None),
+        "pdf": {"path": str(pdf_path), "sha256": pdf_sha256},
+        "toc": {"path": str(toc_path), "sha256": toc_sha256},
+        "counts": {
+            "chapters": len(chapters),
+            "sections": sum(len(entry['search_texts']) for entry in sections.values()),
+            "chunks": len(chunks),
+            "chapter_tokens": sum(chapter['tokens'] for chapter in chapters),
+        },
+        "build_seconds": timings,
+        "workers": workers,
+        # Includes pages and chunks served from the ingest cache, so re-builds report higher rates.
+        "throughput": {
+            "pages_per_s": round(len(pages) / max(timings["pages"], 1e-3), 1),
+            "chunks_per_s": round(len(chunks) / max(timings["chunks"], 1e-3), 1),
+        },
+        "files": sorted(path.name for path in tmp_dir.iterdir()),
+    }
+    # The manifest is written last: a bundle without one is incomplete and never loaded.
+    _write_json(tmp_dir / "manifest.json", manifest)
+
+    if out_dir.exists() and not (out_dir / "manifest.json").exists() and any(out_dir.iterdir()):
+        # e.g. BUNDLE_DIR itself, which holds the bundles of every document.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise ValueError(f"'{out_dir}' is not an index bundle; refusing to replace it.")
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return manifest
+
+def read_bundle(bundle_dir: Path, pdf_path: str = None, toc_path: str = None):
+    """
+    Loads a bundle read-only (vectors are memory-mapped). Returns None when it is missing,
+    from another format version or model, or built from a different PDF/TOC than given.
+    """
+    bundle_dir = Path(bundle_dir)
+    manifest_path = bundle_dir / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION or manifest.get("embedding_model") != EMBEDDING_MODEL_NAME:
+        print(f"Ignoring index bundle '{bundle_dir}': built with another format or model.")
+        return None
+    if (pdf_path and _sha256_file(pdf_path) != manifest["pdf"]["sha256"]) or \
+            (toc_path and _sha256_file(toc_path) != manifest["toc"]["sha256"]):
+        print(f"Ignoring index bundle '{bundle_dir}': it was built from a different PDF or TOC.")
+        return None
+
+    def load_json(name):
+        with open(bundle_dir / name, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load_vectors(name):
+        return np.load(bundle_dir / name, mmap_mode="r")
+
+    chapters = load_json("chapters.json")
+    summary_data = [{"title": chapter['title'], "text": chapter['text']} for chapter in chapters]
+    chapter_router = ChapterRouter([chapter['title'] for chapter in chapters], load_vectors("chapter_vectors.npy"))
+
+    sections = load_json("sections.json")
+    section_index = {title: dict(entry) for title, entry in sections.items()}
+    for field, vector_field in SECTION_FIELDS:
+        vectors, offset = load_vectors(f"{vector_field}.npy"), 0
+        for entry in section_index.values():
+            entry[vector_field] = vectors[offset:offset + len(entry[field])]
+            offset += len(entry[field])
+
+    text_chunks = [chunk['text'] for chunk in load_json("chunks.json")]
+    return IndexBundle(summary_data, chapter_router, section_index, text_chunks,
+                       load_vectors("chunk_embeddings.npy"), manifest)
+
+@st.cache_resource
+def load_index_bundle(pdf_path: str, toc_path: str, bundle_dir: str = str(DEFAULT_BUNDLE_DIR)) -> IndexBundle:
+    """
+    The apps' single entry point to the indexes: the prebuilt bundle when it matches the
+    PDF/TOC, otherwise the same indexes built in-process (slow cold start).
+    """
+    bundle = read_bundle(bundle_dir, pdf_path, toc_path)
+    if bundle is not None:
+        return bundle
+    summary_data = load_summary_data(pdf_path, toc_path)
+    text_chunks, chunk_embeddings = create_document_index(pdf_path)
+    if not summary_data:
+        return IndexBundle(summary_data, None, {}, text_chunks, chunk_embeddings)
+    return IndexBundle(summary_data, get_chapter_router(summary_data), get_section_index(pdf_path, toc_path),
+                       text_chunks, chunk_embeddings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the versioned index bundle loaded by the Streamlit apps.")
+    parser.add_argument("--pdf", default="./data/BU.pdf")
+    parser.add_argument("--toc", default="./data/toc.json")
+    parser.add_argument("--out", default=str(DEFAULT_BUNDLE_DIR))
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help="Processes for page extraction and embedding (default: INGEST_WORKERS or 1).")
+    parser.add_argument("--corpus", action="store_true",
+                        help="Build one bundle per document of data/corpus.json (or the default document) instead.")
+    args = parser.parse_args()
+
+    if args.corpus:
+        from corpus import load_corpus_spec
+        targets = [(spec["pdf"], spec["toc"], spec["bundle"]) for spec in load_corpus_spec()]
+    else:
+        targets = [(args.pdf, args.toc, args.out)]
+    for pdf_path, toc_path, out_dir in targets:
+        manifest = build_bundle(pdf_path, toc_path, Path(out_dir), args.workers)
+        print(f"Wrote index bundle {manifest['bundle_version']} to '{out_dir}': "
+              f"{manifest['counts']['chapters']} chapters, {manifest['counts']['sections']} sections, "
+              f"{manifest['counts']['chunks']} chunks in {sum(manifest['build_seconds'].values()):.1f} s "
+              f"({manifest['throughput']['pages_per_s']:.0f} pages/s, {manifest['throughput']['chunks_per_s']:.0f} chunks/s, "
+              f"{manifest['workers']} worker(s)).")
+
+if __name__ == "__main__":
+    main()
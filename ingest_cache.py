@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import streamlit as st
+
+from embedding_backend import EMBEDDING_BACKEND, create_embedding_backend
+from tracing import record_cache, traced
+
+INGEST_CACHE_PATH = Path("index_cache") / "ingest.sqlite3"
+# SQLite caps the number of bound parameters per statement.
+_QUERY_BATCH = 500
+# Processes used for page extraction and embedding during ingestion; `index_bundle.py --workers` overrides it.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+EMBEDDING_BATCH_SIZE = 64
+
+def page_content_hash(page) -> str:
+    """
+    Hashes what determines a page's extracted text: its content streams, geometry and
+    fonts. Unchanged pages keep their hash across PDF revisions even if objects move.
+    """
+    digest = hashlib.sha256(page.read_contents())
+    digest.update(f"{tuple(page.rect)}:{page.rotation}".encode("utf-8"))
+    for _, ext, font_type, basefont, name, encoding, *_ in page.get_fonts():
+        digest.update(f"{ext}:{font_type}:{basefont}:{name}:{encoding}".encode("utf-8"))
+    return digest.hexdigest()
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class IngestCache:
+    """
+    SQLite store for incremental ingestion: extracted text and layout lines per page
+    content hash, and unit-normalized embeddings per (model, text hash).
+    """
+
+    def __init__(self, path: Path = INGEST_CACHE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS pages (hash TEXT PRIMARY KEY, text TEXT NOT NULL, lines TEXT NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, text_hash))"
+            )
+
+    def _select(self, query: str, prefix: tuple, keys: list) -> list:
+        rows = []
+        with self._lock:
+            for start in range(0, len(keys), _QUERY_BATCH):
+                batch = keys[start:start + _QUERY_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows.extend(self._conn.execute(query.format(placeholders=placeholders), (*prefix, *batch)).fetchall())
+        return rows
+
+    def get_pages(self, hashes: list) -> dict:
+        """{hash: (text, lines)} for the cached pages among `hashes`."""
+        rows = self._select("SELECT hash, text, lines FROM pages WHERE hash IN ({placeholders})", (), list(set(hashes)))
+        return {h: (text, [tuple(line) for line in json.loads(lines)]) for h, text, lines in rows}
+
+    def put_pages(self, pages: list):
+        """Stores (hash, text, lines) records."""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pages (hash, text, lines) VALUES (?, ?, ?)",
+                [(h, text, json.dumps(lines, ensure_ascii=False)) for h, text, lines in pages],
+            )
+
+    def get_vectors(self, model_name: str, hashes: list) -> dict:
+        rows = self._select("SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                            (model_name,), list(set(hashes)))
+        return {h: np.frombuffer(vector, dtype=np.float32) for h, vector in rows}
+
+    def put_vectors(self, model_name: str, items: dict):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model_name, h, np.asarray(vector, dtype=np.float32).tobytes()) for h, vector in items.items()],
+            )
+
+@st.cache_resource
+def get_ingest_cache() -> IngestCache:
+    return IngestCache()
+
+_worker_model = None
+
+def _init_encode_worker(model_name: str, backend: str, threads: int):
+    """Creates one model per worker process; workers split the cores instead of oversubscribing them."""
+    global _worker_model
+    _worker_model = create_embedding_backend(model_name, backend, threads)
+
+def _encode_batch(texts: list) -> np.ndarray:
+    return np.asarray(_worker_model.encode(texts, normalize_embeddings=True, batch_size=len(texts)), dtype=np.float32)
+
+def encode_parallel(model_name: str, texts: list, workers: int, batch_size: int = EMBEDDING_BATCH_SIZE,
+                    backend: str = EMBEDDING_BACKEND) -> np.ndarray:
+    """Unit-normalized embeddings of `texts`, encoded in batches by `workers` processes, in input order."""
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_encode_worker,
+                             initargs=(model_name, backend, threads)) as pool:
+        return np.vstack(list(pool.map(_encode_batch, batches)))
+
+@traced("embed.batch")
+def encode_with_cache(model, model_name: str, texts: list, cache: IngestCache = None, workers: int = None) -> np.ndarray:
+    """
+    Unit-normalized float32 embeddings for `texts`. Only texts never encoded with this
+    model before are sent to the model; the rest come from the cache. With more than one
+    worker, large batches are encoded by a process pool instead of `model`.
+    """
+    if cache is None:
+        cache = get_ingest_cache()
+    workers = INGEST_WORKERS if workers is None else workers
+    hashes = [text_hash(text) for text in texts]
+    vectors = cache.get_vectors(model_name, hashes)
+    missing = list(dict.fromkeys(h for h in hashes if h not in vectors))
+    record_cache("embeddings", hits=len(hashes) - len(missing), misses=len(missing))
+    if missing:
+        texts_by_hash = dict(zip(hashes, texts))
+        missing_texts = [texts_by_hash[h] for h in missing]
+        start = time.perf_counter()
+        if workers > 1 and len(missing_texts) > 2 * EMBEDDING_BATCH_SIZE:
+            # Workers run the same backend as `model`.
+            encoded = encode_parallel(model_name, missing_texts, workers, backend=getattr(model, "name", EMBEDDING_BACKEND))
+        else:
+            workers = 1
+            encoded = np.asarray(model.encode(missing_texts, normalize_embeddings=True), dtype=np.float32)
+        elapsed = time.perf_counter() - start
+        print(f"Embedded {len(missing_texts)} chunks in {elapsed:.1f} s "
+              f"({len(missing_texts) / max(elapsed, 1e-9):.0f} chunks/s, {workers} worker(s)).")
+        new_vectors = dict(zip(missing, encoded))
+        cache.put_vectors(model_name, new_vectors)
+        vectors.update(new_vectors)
+    if not texts:
+        return np.zeros((0, model.dimension), dtype=np.float32)
+    return np.vstack([vectors[h] for h in hashes])
@@ -0,0 +1,245 @@
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from rate_limit import QuotaExceededError, get_rate_limiter
+from tracing import record_usage, span
+
+# Calls in flight per model (or external API) at any time, across all sessions of the process.
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 4))
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+class LLMErrorResult(str):
+    """
+    A failed call, returned in place of the completion text. It reads as the usual
+    "An error occurred..." message, so it can be shown as is, and carries `kind`
+    ("rate_limited", "timeout", "unavailable", "rejected" or "client"), the HTTP `status`
+    and the number of `attempts` for code that needs to tell failures from answers.
+    """
+
+    def __new__(cls, message: str, kind: str, model: str = None, status: int = None, attempts: int = 0):
+        result = super().__new__(cls, message)
+        result.kind = kind
+        result.model = model
+        result.status = status
+        result.attempts = attempts
+        return result
+
+class LLMCallError(Exception):
+    """Raised by LLMGateway.call when retries are exhausted or the error is not retryable."""
+
+    def __init__(self, kind: str, cause: Exception, status: int = None, attempts: int = 0):
+        super().__init__(f"{cause}")
+        self.kind = kind
+        self.cause = cause
+        self.status = status
+        self.attempts = attempts
+
+    def as_result(self, message_prefix: str, model: str = None) -> LLMErrorResult:
+        return LLMErrorResult(f"{message_prefix}: {self}", self.kind, model, self.status, self.attempts)
+
+def _parse_duration(value) -> float:
+    """Seconds in a header value: "12", "1.5", "7.66s", "2m59.56s" or "250ms". None if unparseable."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    scale = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+def _status_and_headers(error: Exception):
+    # Groq SDK errors carry status_code and response; requests' HTTPError only the response.
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    headers = getattr(response, "headers", None) or {}
+    return status, headers
+
+def _classify(error: Exception, status: int):
+    """(kind, retryable) for an exception raised by a client call."""
+    name = type(error).__name__
+    if status == 429:
+        return "rate_limited", True
+    if isinstance(error, TimeoutError) or "Timeout" in name or status == 408:
+        return "timeout", True
+    if isinstance(error, ConnectionError) or "Connection" in name or (status is not None and status in RETRYABLE_STATUSES):
+        return "unavailable", True
+    if status is not None:
+        return "rejected", False
+    return "client", False
+
+def error_result(error: Exception, message_prefix: str, model: str = None) -> LLMErrorResult:
+    """The LLMErrorResult for an exception raised outside LLMGateway.call, e.g. in the middle of a stream."""
+    if isinstance(error, LLMCallError):
+        return error.as_result(message_prefix, model)
+    status, _ = _status_and_headers(error)
+    kind, _ = _classify(error, status)
+    return LLMErrorResult(f"{message_prefix}: {error}", kind, model, status)
+
+def retry_after_seconds(headers) -> float:
+    """How long the server asked us to wait: Retry-After, else the latest rate-limit reset. None if not given."""
+    retry_after = _parse_duration(headers.get("retry-after"))
+    if retry_after is not None:
+        return retry_after
+    resets = [_parse_duration(headers.get(name)) for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+class LLMGateway:
+    """
+    The single path for Groq (and similarity API) calls. Per model it bounds the calls in
+    flight, draws from the model's token bucket, and retries rate-limit, timeout and
+    server errors with exponential backoff and full jitter. A 429 pauses every caller of
+    that model for the server's Retry-After, and the rate-limit headers of successful
+    responses resize the token bucket, so throughput follows the real quota.
+    """
+
+    def __init__(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, max_retries: int = MAX_RETRIES,
+                 backoff_base: float = BACKOFF_BASE_SECONDS, backoff_max: float = BACKOFF_MAX_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots = {}
+        self._paused_until = {}
+        self._lock = threading.Lock()
+
+    def _slot(self, key: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_concurrency)
+            return self._slots[key]
+
+    @contextmanager
+    def slot(self, key: str):
+        """Holds one of the model's concurrency slots, e.g. for the whole length of a stream."""
+        with span("llm.queue_wait", model=key):
+            self._slot(key).acquire()
+        try:
+            yield
+        finally:
+            self._slot(key).release()
+
+    def _wait_until_resumed(self, key: str):
+        while True:
+            with self._lock:
+                remaining = self._paused_until.get(key, 0.0) - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def _pause(self, key: str, seconds: float):
+        with self._lock:
+            self._paused_until[key] = max(self._paused_until.get(key, 0.0), time.monotonic() + seconds)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0.0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+
+    def observe_headers(self, key: str, headers, rate_limiter=None):
+        """Applies the rate-limit headers of a successful response (Groq: tokens per minute, daily requests)."""
+        if rate_limiter is not None:
+            limit_tokens = _parse_duration(headers.get("x-ratelimit-limit-tokens"))
+            remaining_tokens = _parse_duration(headers.get("x-ratelimit-remaining-tokens"))
+            rate_limiter.update_from_server(tokens_per_minute=limit_tokens, remaining_tokens=remaining_tokens)
+        if _parse_duration(headers.get("x-ratelimit-remaining-requests")) == 0:
+            reset = _parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset:
+                self._pause(key, reset)
+
+    def call(self, key: str, fn, rate_limiter=None, tokens: int = 0, hold_slot: bool = True):
+        """
+        Returns fn(), retried on retryable errors. Raises LLMCallError otherwise. `key` names
+        the model (or API) whose slots, pause and `rate_limiter` apply.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self._wait_until_resumed(key)
+            if rate_limiter is not None:
+                with span("llm.rate_limit_wait", model=key):
+                    try:
+                        rate_limiter.acquire(tokens)
+                    except QuotaExceededError as e:
+                        # Too large to ever be accepted; retrying would not help.
+                        raise LLMCallError("rejected", e, None, attempt) from e
+            try:
+                if hold_slot:
+                    with self.slot(key):
+                        return fn()
+                return fn()
+            except Exception as e:
+                status, headers = _status_and_headers(e)
+                kind, retryable = _classify(e, status)
+                if not retryable or attempt > self.max_retries:
+                    raise LLMCallError(kind, e, status, attempt) from e
+                delay = retry_after_seconds(headers) if kind == "rate_limited" else None
+                if delay is not None:
+                    # Everyone calling this model waits for the quota to reset, not just this caller.
+                    self._pause(key, delay)
+                else:
+                    delay = self._backoff(attempt)
+                print(f"{key}: {kind} (status {status}), retry {attempt}/{self.max_retries} in {delay:.1f} s.")
+                with span("llm.backoff", model=key, kind=kind, attempt=attempt):
+                    time.sleep(delay)
+
+    def _create(self, client, model_name: str, prompt: str, rate_limiter, stream: bool = False):
+        messages = [{"role": "user", "content": prompt}]
+        completions = client.chat.completions
+        raw = getattr(completions, "with_raw_response", None)
+        if raw is None:
+            return completions.create(model=model_name, messages=messages, stream=stream)
+        response = raw.create(model=model_name, messages=messages, stream=stream)
+        self.observe_headers(model_name, response.headers, rate_limiter)
+        return response.parse()
+
+    def complete(self, client, model_name: str, prompt: str, tokens: int = 0, rate_limiter=None,
+                 error_prefix: str = "An error occurred"):
+        """
+        The completion text, or an LLMErrorResult. Each attempt draws `tokens` from
+        `rate_limiter` (the model's shared token bucket by default).
+        """
+        if rate_limiter is None:
+            rate_limiter = get_rate_limiter(model_name)
+        with span("llm.completion", model=model_name) as current:
+            try:
+                response = self.call(model_name, lambda: self._create(client, model_name, prompt, rate_limiter),
+                                     rate_limiter, tokens)
+            except LLMCallError as e:
+                current.set(error_kind=e.kind, attempts=e.attempts)
+                return e.as_result(error_prefix, model_name)
+            record_usage(model_name, getattr(response, "usage", None))
+        return response.choices[0].message.content
+
+    def stream(self, client, model_name: str, prompt: str, tokens: int = 0, rate_limiter=None):
+        """
+        Opens a streamed completion (retried like `complete`) and yields its chunks while
+        holding a concurrency slot. Raises LLMCallError when it cannot be opened.
+        """
+        if rate_limiter is None:
+            rate_limiter = get_rate_limiter(model_name)
+        with self.slot(model_name):
+            chunks = self.call(model_name, lambda: self._create(client, model_name, prompt, rate_limiter, stream=True),
+                               rate_limiter, tokens, hold_slot=False)
+            yield from chunks
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_gateway() -> LLMGateway:
+    """The process-wide gateway."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
@@ -1,100 +1,498 @@
 import streamlit as st
-import fitz, re, os
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import re, os
+import hashlib
+import json
+import shutil
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from pathlib import Path
 import numpy as np
-from summarizer_engine import get_chapter_text
+from bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+from chat import DEFAULT_QA_CONTEXT_TOKENS, num_tokens_from_string, split_text_by_tokens
+from embedding_backend import EMBEDDING_BACKEND, EmbeddingBatcher, create_embedding_backend
+from ingest_cache import encode_with_cache
+from tracing import TRACER, annotate, record_cache, span, traced
+from summarizer_engine import get_chapter_text, load_summary_data, load_chapter_sections, extract_pages
+
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# On-disk document index: one sub-directory per (PDF bytes, model) pair.
+INDEX_DIR = Path("index_cache")
+# Bump when the layout or content of a persisted index changes.
+INDEX_FORMAT_VERSION = 2
+
+RETRIEVAL_MODES = ("chapter", "global", "hybrid", "lexical", "auto")
+# In "auto" mode, questions whose best chapter similarity is below this use the global search.
+ROUTER_CONFIDENCE_THRESHOLD = 0.35
+# Sections within the routed chapter are ranked by this blend of heading and section-text
+# similarity (the rest of the weight goes to the section text).
+HEADING_WEIGHT = 0.7
+# Ranked passages are packed into the context until it holds CONTEXT_TOKENS tokens (see
+# chat.qa_context_budget for the per-model budgets). Each pick maximizes MMR_LAMBDA * relevance
+# minus the rest times the similarity to passages already packed, so near-duplicates are skipped.
+CONTEXT_TOKENS = DEFAULT_QA_CONTEXT_TOKENS
+CONTEXT_CANDIDATES = 12
+MMR_LAMBDA = 0.7
+# Passages at least this similar to one already packed are dropped outright.
+NEAR_DUPLICATE_SIMILARITY = 0.95
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+GLOBAL_SOURCE_LABEL = "Whole document"
+# Candidates taken from each ranking before reciprocal rank fusion.
+HYBRID_CANDIDATES = 20
+# In "auto" mode, short keyword questions and course-code lookups skip the embedding model.
+LEXICAL_MAX_TERMS = 3
+LEXICAL_QUERY_PATTERN = re.compile(r"\b[A-Z]{3,4}\s?\d{3}\b")
 
 @st.cache_resource
 def get_embedding_model():
-    return SentenceTransformer('all-MiniLM-L6-v2')
+    """
+    The EMBEDDING_BACKEND implementation of EMBEDDING_MODEL_NAME. Creating it is cheap;
+    the framework import and the weights are loaded on the first encode.
+    """
+    return create_embedding_backend(EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND)
+
+def _record_query_batch(size: int, seconds: float):
+    TRACER.record("embed.query_batch", seconds, size=size)
 
-@st.cache_data
-def create_document_index(pdf_path: str):
+@st.cache_resource
+def get_query_encoder() -> EmbeddingBatcher:
+    """The process-wide batching query encoder, shared by all sessions."""
+    return EmbeddingBatcher(get_embedding_model(), on_batch=_record_query_batch)
+
+def encode_query(question: str) -> np.ndarray:
+    """
+    Unit-normalized, read-only embedding of a question. Concurrent questions from all
+    sessions are encoded together, and repeated questions come from an LRU cache.
+    """
+    future = get_query_encoder().submit(question)
+    if future.done():
+        record_cache("query_embeddings", hits=1)
+        return future.result()
+    with span("embed.query"):
+        record_cache("query_embeddings", misses=1)
+        return future.result()
+
+def _document_index_key(pdf_path: str, model_name: str) -> str:
+    """Hashes the PDF bytes together with the model name and index format."""
+    digest = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    digest.update(model_name.encode("utf-8"))
+    digest.update(str(INDEX_FORMAT_VERSION).encode("utf-8"))
+    return digest.hexdigest()[:24]
+
+def _load_persisted_index(index_path: Path):
+    """Loads chunk texts and a memory-mapped embedding matrix, or None if absent/corrupt."""
+    chunks_file, embeddings_file = index_path / "chunks.json", index_path / "embeddings.npy"
+    if not (chunks_file.exists() and embeddings_file.exists()):
+        return None
     try:
-        doc = fitz.open(pdf_path)
-        full_text = "".join(page.get_text() for page in doc)
-        doc.close()
+        with open(chunks_file, "r", encoding="utf-8") as f:
+            text_chunks = json.load(f)
+        chunk_embeddings = np.load(embeddings_file, mmap_mode="r")
+    except Exception as e:
+        print(f"Ignoring unreadable document index at '{index_path}': {e}")
+        return None
+    if chunk_embeddings.ndim != 2 or chunk_embeddings.shape[0] != len(text_chunks):
+        return None
+    return text_chunks, chunk_embeddings
+
+def _index_source(index_path: Path):
+    """The PDF path an index was built from, or None for indexes that do not record it."""
+    try:
+        with open(index_path / "source.json", "r", encoding="utf-8") as f:
+            return json.load(f).get("pdf")
+    except (OSError, ValueError):
+        return None
+
+def _persist_index(index_path: Path, text_chunks: list, chunk_embeddings: np.ndarray, pdf_path: str):
+    """
+    Writes the index atomically and removes indexes built from older versions of the same
+    PDF path (or another model). Other documents' indexes in INDEX_DIR are kept.
+    """
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_name(f"{index_path.name}.tmp{os.getpid()}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir()
+    source = str(Path(pdf_path).resolve())
+    with open(tmp_path / "source.json", "w", encoding="utf-8") as f:
+        json.dump({"pdf": source}, f)
+    with open(tmp_path / "chunks.json", "w", encoding="utf-8") as f:
+        json.dump(text_chunks, f, ensure_ascii=False)
+    np.save(tmp_path / "embeddings.npy", np.ascontiguousarray(chunk_embeddings, dtype=np.float32))
+    try:
+        os.replace(tmp_path, index_path)
+    except OSError:
+        if _load_persisted_index(index_path) is not None:
+            # Another process published the same index first; theirs is equivalent.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        # A corrupt or partial index from an interrupted run: replace it, or give up (the caller logs the error).
+        shutil.rmtree(index_path, ignore_errors=True)
+        try:
+            os.replace(tmp_path, index_path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+    for stale in index_path.parent.iterdir():
+        if (stale.is_dir() and stale.name != index_path.name and ".tmp" not in stale.name
+                and _index_source(stale) == source):
+            shutil.rmtree(stale, ignore_errors=True)
+
+# cache_resource (not cache_data) so the memory-mapped matrix is shared instead of pickled into RAM.
+@st.cache_resource
+@traced("index.document_chunks")
+def create_document_index(pdf_path: str, _workers: int = None):
+    """
+    Returns (text_chunks, chunk_embeddings) for the PDF, with unit-normalized rows. The index is persisted under
+    INDEX_DIR keyed by a hash of the PDF bytes and the model name, so a restarted process
+    only memory-maps a float32 .npy file; it is rebuilt only when the PDF or model changes.
+    `_workers` processes extract pages and embed chunks when it is rebuilt (default INGEST_WORKERS).
+    """
+    try:
+        index_path = INDEX_DIR / _document_index_key(pdf_path, EMBEDDING_MODEL_NAME)
+    except OSError as e:
+        st.error(f"QA Engine Error: Failed to read PDF '{pdf_path}': {e}")
+        return None, None
+
+    persisted = _load_persisted_index(index_path)
+    record_cache("document_index", hits=int(persisted is not None), misses=int(persisted is None))
+    if persisted is not None:
+        return persisted
+
+    try:
+        # Page texts come from the ingest cache; only changed pages are parsed again.
+        full_text = "".join(page['text'] for page in extract_pages(pdf_path, _workers))
     except Exception as e:
         st.error(f"QA Engine Error: Failed to read PDF '{pdf_path}': {e}")
         return None, None
     chunks = re.split(r'\n\s*\n', full_text)
     text_chunks = [chunk.strip() for chunk in chunks if len(chunk.strip()) > 100]
     if not text_chunks: return None, None
-    model = get_embedding_model()
-    chunk_embeddings = model.encode(text_chunks)
-    return text_chunks, chunk_embeddings
+    # Chunks whose text is unchanged reuse their cached embeddings.
+    chunk_embeddings = encode_with_cache(get_embedding_model(), EMBEDDING_MODEL_NAME, text_chunks, workers=_workers)
+    try:
+        _persist_index(index_path, text_chunks, chunk_embeddings, pdf_path)
+    except OSError as e:
+        print(f"Could not persist document index to '{index_path}': {e}")
+        return text_chunks, chunk_embeddings
+    return _load_persisted_index(index_path) or (text_chunks, chunk_embeddings)
+
+def latency_stats(samples) -> dict:
+    """p50/p95 in milliseconds of latency samples given in seconds."""
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.size == 0:
+        return {"count": 0, "p50_ms": None, "p95_ms": None}
+    p50, p95 = np.percentile(samples * 1000.0, [50, 95])
+    return {"count": int(samples.size), "p50_ms": float(p50), "p95_ms": float(p95)}
 
-def find_context_in_relevant_chapter(question: str, summary_data: list):
+class ChapterRouter:
     """
-    Finds the most relevant chapter using an "augmented search" (title + content snippet),
-    then uses a hybrid scoring model to find the most precise sub-sections for the answer.
+    Picks the chapter for a question. Chapter vectors (title + first 500 characters) are
+    encoded and unit-normalized once, so each question costs one query encode plus a
+    matrix-vector product. Recent routing latencies are kept for p50/p95 reporting.
     """
-    model = get_embedding_model()
-    
-    # --- MODIFICATION: Create an "augmented" text for each chapter for better search ---
-    # This combines the title with the first 500 characters of the chapter text.
-    chapter_titles = [item['title'] for item in summary_data]
-    searchable_chapter_texts = [f"{item['title']}\n\n{item['text'][:500]}" for item in summary_data]
-    
-    question_embedding = model.encode([question])
-    # Generate embeddings from the new, richer text
-    title_embeddings = model.encode(searchable_chapter_texts)
-    
-    # Find the best matching chapter based on the augmented text
-    similarities = cosine_similarity(question_embedding, title_embeddings)[0]
-    best_chapter_index = np.argmax(similarities)
-    best_chapter_title = chapter_titles[best_chapter_index] # Get the original clean title
 
-    chapter_text = get_chapter_text(summary_data, best_chapter_title)
-    if not chapter_text:
-        return None
+    def __init__(self, titles: list, chapter_vectors: np.ndarray, latency_window: int = 1000):
+        self.titles = list(titles)
+        self.chapter_vectors = np.asarray(chapter_vectors, dtype=np.float32)
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_summary_data(cls, summary_data: list, model):
+        searchable_chapter_texts = [f"{item['title']}\n\n{item['text'][:500]}" for item in summary_data]
+        chapter_vectors = encode_with_cache(model, EMBEDDING_MODEL_NAME, searchable_chapter_texts)
+        return cls([item['title'] for item in summary_data], chapter_vectors)
+
+    @traced("retrieve.route_chapter")
+    def route(self, question: str, question_embedding=None):
+        """Returns (best_chapter_index, similarities, question_embedding) for the question."""
+        start = time.perf_counter()
+        if question_embedding is None:
+            question_embedding = encode_query(question)
+        similarities = self.chapter_vectors @ question_embedding
+        best_chapter_index = int(np.argmax(similarities))
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._latencies.append(elapsed)
+        return best_chapter_index, similarities, question_embedding
+
+    def latency_samples(self) -> list:
+        """Recent routing latencies in seconds."""
+        with self._lock:
+            return list(self._latencies)
+
+    def latency_stats(self) -> dict:
+        """p50/p95 routing latency in milliseconds over the recent window."""
+        return latency_stats(self.latency_samples())
 
-    # Split chapter into sections based on ALL-CAPS headings
+@st.cache_resource
+def get_chapter_router(summary_data: list) -> ChapterRouter:
+    return ChapterRouter.from_summary_data(summary_data, get_embedding_model())
+
+def _split_heading_sections(chapter_text: str) -> list:
+    """Fallback split on ALL-CAPS heading lines, for when no PDF layout sections are available."""
     parts = re.split(r'(?m)(^\s*[A-Z][A-Z\s.()&’]{4,99}\s*$)', chapter_text)
-    
-    structured_chunks = []
+    sections = []
     i = 1 if not parts[0].strip() else 0
     while i < len(parts) -1:
-        heading = parts[i].strip()
-        content = parts[i+1].strip()
-        if heading and content:
-            structured_chunks.append({
-                'heading': heading,
-                'content': content,
-                'search_text': f"{heading}\n{content}"
-            })
+        sections.append({'heading': parts[i].strip(), 'content': parts[i+1].strip()})
         i += 2
+    return sections
 
-    if len(structured_chunks) > 1:
-        headings = [chunk['heading'] for chunk in structured_chunks]
-        search_texts = [chunk['search_text'] for chunk in structured_chunks]
+@traced("index.sections")
+def build_section_index(summary_data: list, chapter_sections, model, workers: int = None) -> dict:
+    """
+    Builds {chapter title: entry} where each entry holds the chapter's sections and
+    paragraphs with unit-normalized heading, section and paragraph vectors. Everything is
+    encoded in three batched calls, so question-time ranking is a lookup plus dot products.
+    Texts already in the ingest cache (e.g. chapters a TOC change did not touch) are not re-encoded.
+    `chapter_sections` comes from load_chapter_sections; None falls back to ALL-CAPS headings.
+    """
+    entries = {}
+    for item in summary_data:
+        title, chapter_text = item['title'], item['text']
+        if chapter_sections is not None:
+            sections = chapter_sections.get(title, [])
+        else:
+            sections = _split_heading_sections(chapter_text)
+        sections = [s for s in sections if s['heading'].strip() and s['content'].strip()]
+        paragraphs = re.split(r'\n\s*\n', chapter_text)
+        entries[title] = {
+            'headings': [s['heading'].strip() for s in sections],
+            'search_texts': [f"{s['heading'].strip()}\n{s['content'].strip()}" for s in sections],
+            'paragraphs': [chunk.strip() for chunk in paragraphs if len(chunk.strip()) > 100],
+        }
 
-        heading_embeddings = model.encode(headings)
-        search_text_embeddings = model.encode(search_texts)
+    for field, vector_field in (('headings', 'heading_vectors'),
+                                ('search_texts', 'search_text_vectors'),
+                                ('paragraphs', 'paragraph_vectors')):
+        all_texts = [text for entry in entries.values() for text in entry[field]]
+        all_vectors = encode_with_cache(model, EMBEDDING_MODEL_NAME, all_texts, workers=workers)
+        offset = 0
+        for entry in entries.values():
+            entry[vector_field] = all_vectors[offset:offset + len(entry[field])]
+            offset += len(entry[field])
+    return entries
 
-        heading_similarities = cosine_similarity(question_embedding, heading_embeddings)[0]
-        search_text_similarities = cosine_similarity(question_embedding, search_text_embeddings)[0]
+@st.cache_resource
+def get_section_index(pdf_path: str, toc_path: str) -> dict:
+    """Section index built once from the PDF layout (font-size headings)."""
+    summary_data = load_summary_data(pdf_path, toc_path)
+    chapter_sections = load_chapter_sections(pdf_path, toc_path)
+    return build_section_index(summary_data, chapter_sections, get_embedding_model())
+
+@st.cache_resource
+def get_text_section_index(summary_data: list) -> dict:
+    """Section index from ALL-CAPS headings, for callers that have no PDF layout."""
+    return build_section_index(summary_data, None, get_embedding_model())
+
+@lru_cache(maxsize=8192)
+def passage_tokens(text: str) -> int:
+    return num_tokens_from_string(text)
+
+def assemble_context(passages: list, scores, vectors: np.ndarray = None, token_budget: int = CONTEXT_TOKENS,
+                     mmr_lambda: float = MMR_LAMBDA) -> str:
+    """
+    Joins the passages that best cover the question within `token_budget` tokens, best first.
+    Picks greedily by maximal marginal relevance: relevance (the scores divided by the best
+    one) weighted by `mmr_lambda`, minus the rest times the highest cosine similarity to a
+    passage already picked. `vectors` are unit-normalized; passages within
+    NEAR_DUPLICATE_SIMILARITY of a picked one are dropped, and without vectors only exact
+    duplicates are. A best passage that alone exceeds the budget is cut to it.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    top_score = float(scores.max()) if len(scores) else 0.0
+    relevance = scores / top_score if top_score > 0 else np.ones(len(scores), dtype=np.float32)
+    first_seen = {}
+    for i in np.argsort(-scores, kind="stable"):
+        first_seen.setdefault(" ".join(passages[i].split()), int(i))
+    remaining = sorted(first_seen.values(), key=lambda i: -scores[i])
+    if not remaining:
+        return ""
 
-        combined_scores = (0.7 * heading_similarities) + (0.3 * search_text_similarities)
+    best = remaining[0]
+    if passage_tokens(passages[best]) > token_budget:
+        context = split_text_by_tokens(passages[best], token_budget)[0]
+        annotate(context_tokens=passage_tokens(context), context_passages=1, context_budget=token_budget)
+        return context
 
-        top_k_indices = np.argsort(combined_scores)[-2:][::-1]
-        relevant_context = "\n\n---\n\n".join([search_texts[i] for i in top_k_indices])
+    separator_tokens = passage_tokens(CONTEXT_SEPARATOR)
+    redundancy = np.zeros(len(passages), dtype=np.float32)
+    picked, used = [], 0
+    while remaining:
+        fitting = [i for i in remaining if redundancy[i] < NEAR_DUPLICATE_SIMILARITY
+                   and used + passage_tokens(passages[i]) + (separator_tokens if picked else 0) <= token_budget]
+        if not fitting:
+            break
+        choice = max(fitting, key=lambda i: mmr_lambda * relevance[i] - (1.0 - mmr_lambda) * redundancy[i])
+        used += passage_tokens(passages[choice]) + (separator_tokens if picked else 0)
+        picked.append(choice)
+        remaining.remove(choice)
+        if vectors is not None:
+            redundancy = np.maximum(redundancy, vectors @ vectors[choice])
+    annotate(context_tokens=used, context_passages=len(picked), context_budget=token_budget)
+    return CONTEXT_SEPARATOR.join(passages[i] for i in picked)
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting the whole array."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=int)
+    candidates = np.argpartition(scores, -k)[-k:]
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+def search_document_chunks(question_vector: np.ndarray, text_chunks: list, chunk_embeddings: np.ndarray,
+                           k: int = CONTEXT_CANDIDATES) -> list:
+    """Top-k (chunk index, similarity) pairs over the whole-document chunk matrix."""
+    similarities = chunk_embeddings @ question_vector
+    return [(int(i), float(similarities[i])) for i in top_k_indices(similarities, k)]
+
+def _global_context(question_vector: np.ndarray, text_chunks: list, chunk_embeddings: np.ndarray,
+                    context_tokens: int = CONTEXT_TOKENS, mmr_lambda: float = MMR_LAMBDA):
+    hits = search_document_chunks(question_vector, text_chunks, chunk_embeddings)
+    indices = [i for i, _ in hits]
+    relevant_context = assemble_context([text_chunks[i] for i in indices], [score for _, score in hits],
+                                        np.asarray(chunk_embeddings[indices], dtype=np.float32), context_tokens, mmr_lambda)
+    return relevant_context, GLOBAL_SOURCE_LABEL
+
+class LexicalIndex:
+    """
+    Passages for keyword retrieval: the whole-document chunks followed by every section of
+    the section index. `sources` names where each passage came from and `dense_vectors`
+    holds the matching normalized embeddings, so BM25 and dense rankings share passage ids.
+    """
+
+    def __init__(self, text_chunks: list, chunk_embeddings: np.ndarray, section_index: dict):
+        self.passages = list(text_chunks)
+        self.sources = [GLOBAL_SOURCE_LABEL] * len(text_chunks)
+        vectors = [np.asarray(chunk_embeddings, dtype=np.float32)]
+        for title, entry in section_index.items():
+            self.passages.extend(entry['search_texts'])
+            self.sources.extend([title] * len(entry['search_texts']))
+            vectors.append(entry['search_text_vectors'])
+        self.dense_vectors = np.vstack(vectors)
+        self.bm25 = BM25Index(self.passages)
+
+    def search_lexical(self, question: str, k: int) -> list:
+        return self.bm25.search(question, k)
+
+    def search_hybrid(self, question: str, question_vector: np.ndarray, k: int) -> list:
+        """Fuses the BM25 and dense rankings with reciprocal rank fusion."""
+        similarities = self.dense_vectors @ question_vector
+        dense_ranking = [(int(i), float(similarities[i])) for i in top_k_indices(similarities, HYBRID_CANDIDATES)]
+        lexical_ranking = self.bm25.search(question, HYBRID_CANDIDATES)
+        return reciprocal_rank_fusion([lexical_ranking, dense_ranking])[:k]
+
+    def context_for(self, hits: list, context_tokens: int = CONTEXT_TOKENS, mmr_lambda: float = MMR_LAMBDA):
+        """Packs the hit passages into the token budget; the source is the best hit's chapter (or the whole document)."""
+        if not hits:
+            return None
+        indices = [i for i, _ in hits]
+        relevant_context = assemble_context([self.passages[i] for i in indices], [score for _, score in hits],
+                                            self.dense_vectors[indices], context_tokens, mmr_lambda)
+        return relevant_context, self.sources[hits[0][0]]
+
+@st.cache_resource
+def get_lexical_index(pdf_path: str, toc_path: str) -> LexicalIndex:
+    text_chunks, chunk_embeddings = create_document_index(pdf_path)
+    if text_chunks is None:
+        return None
+    return LexicalIndex(text_chunks, chunk_embeddings, get_section_index(pdf_path, toc_path))
+
+def is_lexical_query(question: str) -> bool:
+    """Keyword-style questions (a few terms, or a course code) that BM25 handles alone."""
+    return len(tokenize(question)) <= LEXICAL_MAX_TERMS or bool(LEXICAL_QUERY_PATTERN.search(question))
+
+@traced("retrieve")
+def find_context_in_relevant_chapter(question: str, summary_data: list, section_index: dict = None,
+                                     text_chunks: list = None, chunk_embeddings: np.ndarray = None,
+                                     retrieval_mode: str = "chapter", lexical_index: LexicalIndex = None,
+                                     chapter_router: ChapterRouter = None, heading_weight: float = HEADING_WEIGHT,
+                                     context_tokens: int = CONTEXT_TOKENS, mmr_lambda: float = MMR_LAMBDA):
+    """
+    Finds the most relevant chapter using an "augmented search" (title + content snippet),
+    then uses a hybrid scoring model to find the most precise sub-sections for the answer.
+    Section vectors come from `section_index` (see get_section_index) and chapter vectors
+    from `chapter_router` (see get_chapter_router), so only the question is encoded here.
+
+    retrieval_mode is one of RETRIEVAL_MODES:
+    - "chapter" always routes to a chapter;
+    - "global" searches the whole-document chunk index (`text_chunks`/`chunk_embeddings`
+      from create_document_index);
+    - "hybrid" fuses BM25 and dense rankings over `lexical_index` (see get_lexical_index);
+    - "lexical" uses BM25 only and never loads the embedding model;
+    - "auto" answers keyword-style questions with BM25 alone, otherwise routes to a chapter
+      and falls back to hybrid (or global) search when the router's best similarity is
+      below ROUTER_CONFIDENCE_THRESHOLD.
+
+    Within the chapter, sections are ranked by `heading_weight` * heading similarity plus the
+    rest times section-text similarity (paragraphs by similarity, for chapters without
+    sections). In every mode the ranked passages are packed by assemble_context into at most
+    `context_tokens` tokens, skipping near-duplicates per `mmr_lambda`. See retrieval_eval.py
+    for tuning them.
+    """
+    if retrieval_mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{retrieval_mode}'. Expected one of {RETRIEVAL_MODES}.")
+    annotate(mode=retrieval_mode)
+    has_chunk_index = text_chunks is not None and chunk_embeddings is not None
+
+    if lexical_index is not None and (
+            retrieval_mode == "lexical" or (retrieval_mode == "auto" and is_lexical_query(question))):
+        lexical_context = lexical_index.context_for(lexical_index.search_lexical(question, CONTEXT_CANDIDATES),
+                                                    context_tokens, mmr_lambda)
+        if lexical_context is not None:
+            return lexical_context
+
+    if retrieval_mode == "hybrid" and lexical_index is not None:
+        question_vector = encode_query(question)
+        return lexical_index.context_for(lexical_index.search_hybrid(question, question_vector, CONTEXT_CANDIDATES),
+                                         context_tokens, mmr_lambda)
+
+    if retrieval_mode == "global" and has_chunk_index:
+        question_vector = encode_query(question)
+        return _global_context(question_vector, text_chunks, chunk_embeddings, context_tokens, mmr_lambda)
+
+    if section_index is None:
+        section_index = get_text_section_index(summary_data)
+    
+    # Chapter vectors (title + content snippet) are precomputed once by the router.
+    router = chapter_router if chapter_router is not None else get_chapter_router(summary_data)
+    best_chapter_index, chapter_similarities, question_vector = router.route(question)
+    best_chapter_title = router.titles[best_chapter_index] # Get the original clean title
+
+    if retrieval_mode == "auto" and chapter_similarities[best_chapter_index] < ROUTER_CONFIDENCE_THRESHOLD:
+        if lexical_index is not None:
+            return lexical_index.context_for(lexical_index.search_hybrid(question, question_vector, CONTEXT_CANDIDATES),
+                                             context_tokens, mmr_lambda)
+        if has_chunk_index:
+            return _global_context(question_vector, text_chunks, chunk_embeddings, context_tokens, mmr_lambda)
+
+    chapter_text = get_chapter_text(summary_data, best_chapter_title)
+    if not chapter_text:
+        return None
+
+    entry = section_index.get(best_chapter_title)
+    # Without sections or paragraphs, the chapter itself is the context, cut to the budget.
+    if entry is None or (len(entry['headings']) <= 1 and not entry['paragraphs']):
+        return assemble_context([chapter_text], [1.0], token_budget=context_tokens), best_chapter_title
+
+    if len(entry['headings']) > 1:
+        heading_similarities = entry['heading_vectors'] @ question_vector
+        search_text_similarities = entry['search_text_vectors'] @ question_vector
+
+        combined_scores = (heading_weight * heading_similarities) + ((1.0 - heading_weight) * search_text_similarities)
+        passages, vectors = entry['search_texts'], entry['search_text_vectors']
     else:
-        # Split the entire chapter text by paragraphs
-        paragraphs = re.split(r'\n\s*\n', chapter_text)
-        text_chunks = [chunk.strip() for chunk in paragraphs if len(chunk.strip()) > 100]
-        
-        # If there are no good paragraphs, just return the whole chapter text
-        if not text_chunks:
-            return chapter_text, best_chapter_title
-            
-        # Find the top 2 most relevant paragraphs
-        chunk_embeddings = model.encode(text_chunks)
-        similarities = cosine_similarity(question_embedding, chunk_embeddings)[0]
-        top_k_indices = np.argsort(similarities)[-2:][::-1]
-        relevant_context = "\n\n---\n\n".join([text_chunks[i] for i in top_k_indices])
-
-        return chapter_text, best_chapter_title
-
-    return relevant_context, best_chapter_title
\ No newline at end of file
+        # Find the most relevant paragraphs
+        combined_scores = entry['paragraph_vectors'] @ question_vector
+        passages, vectors = entry['paragraphs'], entry['paragraph_vectors']
+
+    best_indices = top_k_indices(combined_scores, CONTEXT_CANDIDATES)
+    relevant_context = assemble_context([passages[i] for i in best_indices], combined_scores[best_indices],
+                                        vectors[best_indices], context_tokens, mmr_lambda)
+    return relevant_context, best_chapter_title
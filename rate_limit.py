@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+# Defaults match the Groq free tier; override per deploy with these environment variables.
+DEFAULT_REQUESTS_PER_MINUTE = int(os.environ.get("GROQ_REQUESTS_PER_MINUTE", 30))
+DEFAULT_TOKENS_PER_MINUTE = int(os.environ.get("GROQ_TOKENS_PER_MINUTE", 6000))
+
+class QuotaExceededError(ValueError):
+    """A single request costs more tokens than the whole per-minute quota; the API would reject it."""
+
+class TokenBucket:
+    """
+    Thread-safe limiter for a requests-per-minute and a tokens-per-minute quota.
+    Both buckets start full and refill continuously; acquire() blocks until a request
+    of the given token cost fits in both.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float = None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute) if tokens_per_minute else 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed_minutes = (now - self._last_refill) / 60.0
+        self._last_refill = now
+        self._request_allowance = min(self.requests_per_minute,
+                                      self._request_allowance + elapsed_minutes * self.requests_per_minute)
+        if self.tokens_per_minute:
+            self._token_allowance = min(self.tokens_per_minute,
+                                        self._token_allowance + elapsed_minutes * self.tokens_per_minute)
+
+    def acquire(self, tokens: int = 0):
+        """
+        Blocks until one request costing `tokens` tokens is allowed, then consumes it.
+        Raises QuotaExceededError when `tokens` is more than the bucket can ever hold.
+        """
+        if not self.tokens_per_minute:
+            tokens = 0
+        elif tokens > self.tokens_per_minute:
+            raise QuotaExceededError(f"Request of {tokens} tokens exceeds the quota of {self.tokens_per_minute:.0f} tokens per minute.")
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                request_deficit = 1.0 - self._request_allowance
+                token_deficit = tokens - self._token_allowance
+                if request_deficit <= 0 and token_deficit <= 0:
+                    self._request_allowance -= 1.0
+                    self._token_allowance -= tokens
+                    return
+                wait_minutes = max(request_deficit / self.requests_per_minute,
+                                   token_deficit / self.tokens_per_minute if self.tokens_per_minute else 0.0)
+            time.sleep(max(wait_minutes * 60.0, 0.01))
+
+    def update_from_server(self, tokens_per_minute: float = None, remaining_tokens: float = None):
+        """
+        Adopts the quota the API reports (e.g. Groq's x-ratelimit-limit-tokens and
+        x-ratelimit-remaining-tokens headers) in place of the configured estimate.
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            if tokens_per_minute:
+                self.tokens_per_minute = tokens_per_minute
+            if remaining_tokens is not None and self.tokens_per_minute:
+                self._token_allowance = min(float(remaining_tokens), self.tokens_per_minute)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model_name: str, requests_per_minute: float = None, tokens_per_minute: float = None) -> TokenBucket:
+    """Returns the process-wide limiter for a model, creating it with the given (or default) quotas."""
+    with _limiters_lock:
+        if model_name not in _limiters:
+            _limiters[model_name] = TokenBucket(requests_per_minute or DEFAULT_REQUESTS_PER_MINUTE,
+                                                tokens_per_minute or DEFAULT_TOKENS_PER_MINUTE)
+        return _limiters[model_name]
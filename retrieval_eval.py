@@ -0,0 +1,156 @@
+import argparse
+import itertools
+import json
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmark import BENCHMARK_DIR, git_commit
+from index_bundle import load_index_bundle
+from qa import (CONTEXT_SEPARATOR, CONTEXT_TOKENS, GLOBAL_SOURCE_LABEL, HEADING_WEIGHT, MMR_LAMBDA, RETRIEVAL_MODES,
+                find_context_in_relevant_chapter, get_query_encoder, latency_stats, passage_tokens)
+
+GOLDEN_PATH = Path("data/golden_questions.json")
+RECALL_AT = (1, 2, 3)
+# Characters compared when locating a passage in a chapter or section.
+MATCH_PREFIX_CHARS = 120
+HEADING_WEIGHTS = (0.5, 0.7, 0.9, 1.0)
+CONTEXT_TOKEN_BUDGETS = (750, 1500, 2500)
+MMR_LAMBDAS = (0.5, 0.7, 1.0)
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).lower()
+
+def parameter_grid(modes=RETRIEVAL_MODES) -> list:
+    """(mode, params) pairs: the section blend for chapter routing, and the context budget and MMR weight for every mode."""
+    grid = []
+    for mode in modes:
+        heading_weights = HEADING_WEIGHTS if mode in ("chapter", "auto") else (HEADING_WEIGHT,)
+        for heading_weight, context_tokens, mmr_lambda in itertools.product(heading_weights, CONTEXT_TOKEN_BUDGETS,
+                                                                            MMR_LAMBDAS):
+            grid.append((mode, {"heading_weight": heading_weight, "context_tokens": context_tokens,
+                                "mmr_lambda": mmr_lambda}))
+    return grid
+
+class GoldenJudge:
+    """Decides which chapter a retrieved passage comes from and whether it covers the expected section."""
+
+    def __init__(self, summary_data: list, section_index: dict):
+        self.chapters = [(item['title'], _normalize(item['text'])) for item in summary_data]
+        self.section_texts = {
+            title: [(_normalize(heading), _normalize(text)) for heading, text in zip(entry['headings'], entry['search_texts'])]
+            for title, entry in section_index.items()
+        }
+        # Section and paragraph passages are known exactly; other passages (chunks) are located by their text.
+        self._chapter_of = {text: title for title, entry in section_index.items()
+                            for text in (*entry['search_texts'], *entry['paragraphs'])}
+
+    def chapter_of(self, passage: str):
+        if passage not in self._chapter_of:
+            probe = _normalize(passage)[:MATCH_PREFIX_CHARS]
+            self._chapter_of[passage] = next((title for title, text in self.chapters if probe in text), None)
+        return self._chapter_of[passage]
+
+    def is_relevant(self, passage: str, golden: dict) -> bool:
+        if self.chapter_of(passage) != golden['chapter']:
+            return False
+        if not golden.get('section'):
+            return True
+        section, passage_text = _normalize(golden['section']), _normalize(passage)
+        for heading, text in self.section_texts.get(golden['chapter'], []):
+            if section in heading and (passage_text[:MATCH_PREFIX_CHARS] in text or text[:MATCH_PREFIX_CHARS] in passage_text):
+                return True
+        return False
+
+def evaluate(indexes, golden_set: list, mode: str, params: dict, judge: GoldenJudge) -> dict:
+    """Chapter accuracy, recall@k and MRR over the ranked passages of each retrieved context, with latency and size."""
+    latencies, chapter_hits, reciprocal_ranks, context_tokens = [], 0, [], []
+    recall_hits = {k: 0 for k in RECALL_AT}
+    for golden in golden_set:
+        # Every question pays for its own query encode, as it would in the app.
+        get_query_encoder().clear_cache()
+        start = time.perf_counter()
+        context_and_source = find_context_in_relevant_chapter(
+            golden['question'], indexes.summary_data, indexes.section_index,
+            text_chunks=indexes.text_chunks, chunk_embeddings=indexes.chunk_embeddings,
+            retrieval_mode=mode, lexical_index=indexes.lexical_index, chapter_router=indexes.chapter_router, **params
+        )
+        latencies.append(time.perf_counter() - start)
+        if context_and_source is None:
+            reciprocal_ranks.append(0.0)
+            continue
+        context, source = context_and_source
+        context_tokens.append(passage_tokens(context))
+        passages = context.split(CONTEXT_SEPARATOR)
+        chapter = judge.chapter_of(passages[0]) if source == GLOBAL_SOURCE_LABEL else source
+        chapter_hits += chapter == golden['chapter']
+        rank = next((i + 1 for i, passage in enumerate(passages) if judge.is_relevant(passage, golden)), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        for k in RECALL_AT:
+            recall_hits[k] += rank is not None and rank <= k
+
+    n = len(golden_set)
+    return {
+        "mode": mode,
+        "params": params,
+        "chapter_accuracy": round(chapter_hits / n, 4),
+        **{f"recall@{k}": round(hits / n, 4) for k, hits in recall_hits.items()},
+        "mrr": round(sum(reciprocal_ranks) / n, 4),
+        "mean_context_tokens": round(sum(context_tokens) / max(1, len(context_tokens)), 1),
+        "latency": latency_stats(latencies),
+    }
+
+def mark_pareto_front(results: list):
+    """Flags configurations that no other one beats on both MRR and p50 latency."""
+    for result in results:
+        result["pareto"] = not any(
+            other["mrr"] >= result["mrr"] and other["latency"]["p50_ms"] <= result["latency"]["p50_ms"]
+            and (other["mrr"] > result["mrr"] or other["latency"]["p50_ms"] < result["latency"]["p50_ms"])
+            for other in results
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Score retrieval strategies and parameters against a golden question set.")
+    parser.add_argument("--pdf", default="./data/BU.pdf")
+    parser.add_argument("--toc", default="./data/toc.json")
+    parser.add_argument("--golden", default=str(GOLDEN_PATH))
+    parser.add_argument("--modes", nargs="+", default=list(RETRIEVAL_MODES), choices=RETRIEVAL_MODES)
+    parser.add_argument("--out", help="Results file (default: benchmarks/retrieval-<git commit>.json).")
+    args = parser.parse_args()
+
+    with open(args.golden, "r", encoding="utf-8") as f:
+        golden_set = json.load(f)
+    indexes = load_index_bundle(args.pdf, args.toc)
+    judge = GoldenJudge(indexes.summary_data, indexes.section_index)
+    # Untimed warm-up so model loading and the lazy BM25 index do not land in the first configuration.
+    find_context_in_relevant_chapter(golden_set[0]['question'], indexes.summary_data, indexes.section_index,
+                                     retrieval_mode="hybrid", lexical_index=indexes.lexical_index,
+                                     chapter_router=indexes.chapter_router)
+
+    results = [evaluate(indexes, golden_set, mode, params, judge) for mode, params in parameter_grid(args.modes)]
+    mark_pareto_front(results)
+    print(f"{'mode':<8} {'params':<58} {'chapter':>7} " + " ".join(f"{'R@' + str(k):>6}" for k in RECALL_AT)
+          + f" {'MRR':>6} {'tokens':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for result in results:
+        params = ", ".join(f"{key}={value}" for key, value in result["params"].items())
+        print(f"{result['mode']:<8} {params:<58} {result['chapter_accuracy']:>7.2f} "
+              + " ".join(f"{result[f'recall@{k}']:>6.2f}" for k in RECALL_AT)
+              + f" {result['mrr']:>6.3f} {result['mean_context_tokens']:>7.0f} {result['latency']['p50_ms']:>8.2f} {result['latency']['p95_ms']:>8.2f}"
+              + ("  *" if result["pareto"] else ""))
+    print("* = not beaten on both MRR and p50 latency by another configuration.")
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "golden": {"path": args.golden, "questions": len(golden_set)},
+        "defaults": {"heading_weight": HEADING_WEIGHT, "context_tokens": CONTEXT_TOKENS, "mmr_lambda": MMR_LAMBDA},
+        "results": results,
+    }
+    out_path = Path(args.out) if args.out else BENCHMARK_DIR / f"retrieval-{report['commit']}.json"
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote retrieval results to '{out_path}'.")
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,175 @@
 import streamlit as st
 import fitz
 import json
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-@st.cache_data
-def load_summary_data(pdf_path, toc_path):
+from ingest_cache import INGEST_WORKERS, get_ingest_cache, page_content_hash
+from tracing import record_cache, traced
+
+# A line is a heading when its font is at least this much larger than the largest body font.
+HEADING_SIZE_DELTA = 1.5
+# Font sizes covering at least this share of the characters are treated as body text.
+BODY_FONT_MIN_SHARE = 0.10
+MAX_HEADING_CHARS = 100
+# Pages are sent to extraction workers in contiguous shards of at least this many pages.
+MIN_PAGES_PER_SHARD = 8
+
+def _load_toc(toc_path):
     try:
         with open(toc_path, 'r') as f:
-            toc_data = json.load(f)
+            return json.load(f)
     except Exception as e:
         st.error(f"Summary Engine Error: Could not load or parse '{toc_path}': {e}")
+        return None
+
+def _chapter_page_ranges(toc_list, offset, page_count):
+    """Yields (title, start_page, end_page) with 0-based, inclusive page numbers."""
+    for i, item in enumerate(toc_list):
+        title, start_page = item['title'], item['page'] - 1 + offset
+        end_page = toc_list[i + 1]['page'] - 2 + offset if i + 1 < len(toc_list) else page_count - 1
+        start_page = max(0, min(start_page, page_count - 1))
+        end_page = max(start_page, min(end_page, page_count - 1))
+        yield title, start_page, end_page
+
+@st.cache_data
+@traced("pdf.load_chapters")
+def load_summary_data(pdf_path, toc_path):
+    toc_data = _load_toc(toc_path)
+    if toc_data is None:
         return []
     
     offset = toc_data.get("page_offset", 0)
     toc_list = toc_data.get("chapters", [])
     if not toc_list: return []
     
-    doc = fitz.open(pdf_path)
+    pages = extract_pages(pdf_path)
     chunks = []
-    for i, item in enumerate(toc_list):
-        title, start_page = item['title'], item['page'] - 1 + offset
-        end_page = toc_list[i + 1]['page'] - 2 + offset if i + 1 < len(toc_list) else len(doc) - 1
-        start_page = max(0, min(start_page, len(doc) - 1))
-        end_page = max(start_page, min(end_page, len(doc) - 1))
-        text = "".join(doc[p].get_text() for p in range(start_page, end_page + 1))
+    for title, start_page, end_page in _chapter_page_ranges(toc_list, offset, len(pages)):
+        text = "".join(pages[p]['text'] for p in range(start_page, end_page + 1))
         chunks.append({"title": title, "text": text.strip()})
-    doc.close()
     return chunks
 
+def _page_lines(page):
+    """Returns (text, font_size, is_bold) for every non-empty text line on the page."""
+    lines = []
+    for block in page.get_text("dict")["blocks"]:
+        for line in block.get("lines", []):
+            spans = [span for span in line["spans"] if span["text"].strip()]
+            if not spans:
+                continue
+            text = "".join(span["text"] for span in spans).strip()
+            size = max(span["size"] for span in spans)
+            is_bold = all(span["flags"] & 16 for span in spans)
+            lines.append((text, size, is_bold))
+    return lines
+
+def _extract_page_range(pdf_path, page_numbers):
+    """Returns (page number, text, lines) for the given pages; workers call it with their own PDF handle."""
+    with fitz.open(pdf_path) as doc:
+        return [(n, doc[n].get_text(), _page_lines(doc[n])) for n in page_numbers]
+
+@st.cache_resource
+@traced("pdf.extract_pages")
+def extract_pages(pdf_path, _workers=None):
+    """
+    Returns [{hash, text, lines}] for every page, opening the PDF once for all consumers.
+    Pages are looked up in the ingest cache by content hash, so after a PDF revision
+    only new or changed pages are parsed again, sharded across `_workers` processes
+    (default INGEST_WORKERS). The result is shared; do not mutate it.
+    """
+    workers = INGEST_WORKERS if _workers is None else _workers
+    cache = get_ingest_cache()
+    start = time.perf_counter()
+    doc = fitz.open(pdf_path)
+    hashes = [page_content_hash(page) for page in doc]
+    known = cache.get_pages(hashes)
+    # Identical pages (e.g. blank ones) are parsed once.
+    first_page_of_hash = {}
+    for page_number, page_hash in enumerate(hashes):
+        if page_hash not in known:
+            first_page_of_hash.setdefault(page_hash, page_number)
+    missing = list(first_page_of_hash.values())
+    record_cache("pages", hits=len(hashes) - len(missing), misses=len(missing))
+    if workers > 1 and len(missing) >= 2 * MIN_PAGES_PER_SHARD:
+        doc.close()
+        # Several shards per worker keep all workers busy when some page ranges are slower to parse.
+        shard_size = max(MIN_PAGES_PER_SHARD, -(-len(missing) // (workers * 4)))
+        shards = [missing[i:i + shard_size] for i in range(0, len(missing), shard_size)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            records = [record for shard in pool.map(_extract_page_range, [pdf_path] * len(shards), shards)
+                       for record in shard]
+    else:
+        workers = 1
+        records = [(n, doc[n].get_text(), _page_lines(doc[n])) for n in missing]
+        doc.close()
+    extracted = []
+    for page_number, text, lines in records:
+        known[hashes[page_number]] = (text, lines)
+        extracted.append((hashes[page_number], text, lines))
+    cache.put_pages(extracted)
+    if extracted:
+        elapsed = time.perf_counter() - start
+        print(f"Extracted {len(extracted)} of {len(hashes)} pages from '{pdf_path}' in {elapsed:.1f} s "
+              f"({len(extracted) / max(elapsed, 1e-9):.0f} pages/s, {workers} worker(s)); the rest came from the page cache.")
+    return [{"hash": h, "text": known[h][0], "lines": known[h][1]} for h in hashes]
+
+def _heading_size_threshold(lines):
+    """Derives the heading font size from the document's own body-text sizes."""
+    chars_per_size = Counter()
+    for text, size, _ in lines:
+        chars_per_size[round(size, 1)] += len(text)
+    total_chars = sum(chars_per_size.values())
+    body_sizes = [size for size, n in chars_per_size.items() if n >= BODY_FONT_MIN_SHARE * total_chars]
+    return max(body_sizes, default=0.0) + HEADING_SIZE_DELTA
+
+def _split_sections(lines, heading_size, leading_heading):
+    """
+    Groups lines into sections; consecutive heading lines form one multi-line heading.
+    Text before the first heading is filed under `leading_heading`.
+    """
+    sections = []
+    heading, content = [leading_heading], []
+    for text, size, _ in lines:
+        if size >= heading_size and len(text) <= MAX_HEADING_CHARS:
+            if content:
+                sections.append((heading, content))
+                heading, content = [], []
+            heading.append(text)
+        else:
+            content.append(text)
+    if content:
+        sections.append((heading, content))
+    return [
+        {"heading": " ".join(heading), "content": "\n".join(content)}
+        for heading, content in sections if heading
+    ]
+
+@st.cache_data
+@traced("pdf.load_sections")
+def load_chapter_sections(pdf_path, toc_path):
+    """
+    Splits every chapter into sections using the PDF layout: lines set in a font clearly
+    larger than the body text are headings. Returns {chapter title: [{heading, content}]}.
+    """
+    toc_data = _load_toc(toc_path)
+    if toc_data is None:
+        return {}
+    offset = toc_data.get("page_offset", 0)
+    toc_list = toc_data.get("chapters", [])
+    if not toc_list: return {}
+
+    page_lines = [page['lines'] for page in extract_pages(pdf_path)]
+    page_count = len(page_lines)
+
+    heading_size = _heading_size_threshold([line for lines in page_lines for line in lines])
+    sections = {}
+    for title, start_page, end_page in _chapter_page_ranges(toc_list, offset, page_count):
+        chapter_lines = [line for p in range(start_page, end_page + 1) for line in page_lines[p]]
+        sections[title] = _split_sections(chapter_lines, heading_size, title)
+    return sections
+
 def get_chapter_text(chapters_data: list, title: str) -> str:
     """A simple helper to find the text for a given chapter title."""
-    return next((item['text'] for item in chapters_data if item['title'] == title), "")
\ No newline at end of file
+    return next((item['text'] for item in chapters_data if item['title'] == title), "")  
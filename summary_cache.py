@@ -0,0 +1,111 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import streamlit as st
+
+from chat import SUMMARY_PROMPT_TEMPLATES, IncompleteSummary, get_summary, theme_prompt_title
+from llm_gateway import LLMErrorResult
+from tracing import record_cache
+
+# Lives next to the source PDF so a pre-warmed cache is deployed together with the data.
+SUMMARY_CACHE_PATH = Path("data/summary_cache.sqlite3")
+# Results that must not be cached because they describe a failure rather than a summary.
+_ERROR_PREFIXES = ("An error", "API Client is not initialized", "Map-Reduce failed")
+
+def summary_cache_key(text: str, model_name: str, prompt_title: str) -> str:
+    """Content address of a summary: the text, model, prompt title and prompt templates."""
+    digest = hashlib.sha256()
+    for part in (text, model_name, prompt_title, *SUMMARY_PROMPT_TEMPLATES):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class SummaryCache:
+    """Persistent, content-addressed store of chapter summaries in SQLite."""
+
+    def __init__(self, path: Path = SUMMARY_CACHE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, prompt_title TEXT NOT NULL, "
+                "summary TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    def get(self, text: str, model_name: str, prompt_title: str):
+        """Returns the cached summary, or None."""
+        key = summary_cache_key(text, model_name, prompt_title)
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+        record_cache("summary", hits=int(row is not None), misses=int(row is None))
+        return row[0] if row else None
+
+    def put(self, text: str, model_name: str, prompt_title: str, summary: str) -> bool:
+        """Stores a summary; error results and incomplete summaries are ignored. Returns whether it was stored."""
+        if (not summary or isinstance(summary, (LLMErrorResult, IncompleteSummary))
+                or summary.startswith(_ERROR_PREFIXES)):
+            return False
+        key = summary_cache_key(text, model_name, prompt_title)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (key, model, prompt_title, summary, created_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, prompt_title, summary, time.time()),
+            )
+        return True
+
+@st.cache_resource
+def get_summary_cache() -> SummaryCache:
+    return SummaryCache()
+
+def prewarm_summaries(client, summary_data: list, model_name: str, cache: SummaryCache) -> dict:
+    """Summarizes every chapter that is not cached yet. Returns counts of cached/new/failed chapters."""
+    counts = {"cached": 0, "new": 0, "failed": 0}
+    for item in summary_data:
+        prompt_title = theme_prompt_title(item['title'])
+        if cache.get(item['text'], model_name, prompt_title) is not None:
+            counts["cached"] += 1
+            continue
+        start = time.perf_counter()
+        summary = get_summary(client, item['text'], model_name, prompt_title)
+        if cache.put(item['text'], model_name, prompt_title, summary):
+            counts["new"] += 1
+            print(f"Summarized '{item['title']}' in {time.perf_counter() - start:.1f} s.")
+        elif isinstance(summary, IncompleteSummary):
+            counts["failed"] += 1
+            print(f"Summarized '{item['title']}' without {summary.failed_calls} failed part(s); not cached.")
+        else:
+            counts["failed"] += 1
+            print(f"Failed to summarize '{item['title']}': {summary}")
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-summarize every chapter of the table of contents into the summary cache.")
+    parser.add_argument("--pdf", default="./data/BU.pdf")
+    parser.add_argument("--toc", default="./data/toc.json")
+    parser.add_argument("--model", default="llama3-70b-8192")
+    parser.add_argument("--cache", default=str(SUMMARY_CACHE_PATH))
+    args = parser.parse_args()
+
+    from groq import Groq
+    from summarizer_engine import load_summary_data
+
+    summary_data = load_summary_data(args.pdf, args.toc)
+    if not summary_data:
+        raise SystemExit(f"No chapters could be loaded from '{args.pdf}' and '{args.toc}'.")
+    # Retries are left to the LLM gateway, as in the apps.
+    client = Groq(api_key=os.environ["GROQ_API_KEY"], max_retries=0)
+    counts = prewarm_summaries(client, summary_data, args.model, SummaryCache(args.cache))
+    print(f"Done: {counts['cached']} already cached, {counts['new']} summarized, {counts['failed']} failed.")
+    if counts["failed"]:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import atexit
+import contextvars
+import functools
+import json
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import streamlit as st
+
+# One JSON object per finished span; set TRACING=0 to turn spans and metrics off.
+TRACE_PATH = Path(os.environ.get("TRACE_PATH", "logs/traces.jsonl"))
+TRACING_ENABLED = os.environ.get("TRACING", "1") != "0"
+# The trace file is rotated at this size; traces.jsonl.1 (newest) ... .N (oldest) are kept.
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", 10 * 1024 * 1024))
+TRACE_BACKUPS = 5
+# Spans waiting for the writer; beyond this they are dropped from the file (never from the aggregates).
+TRACE_QUEUE_SIZE = 10000
+# Recent durations kept per span name for p50/p95.
+SPAN_WINDOW = 1000
+# When set, the apps serve Prometheus text metrics on this port at /metrics.
+METRICS_PORT = os.environ.get("METRICS_PORT")
+
+# The innermost open span of the current thread or task; spans opened inside it become its children.
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    """An open span. `set()` adds attributes that are written out when the span ends."""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attrs")
+
+    def __init__(self, name: str, trace_id: str, span_id: str, parent_id: str, attrs: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+class JsonlSink:
+    """
+    Appends records to a JSONL file from a daemon thread. log() only puts the record on a
+    bounded queue, so callers never wait for the disk; when the queue is full the record
+    is dropped and counted. The file is rotated once it reaches `max_bytes`, keeping
+    `backups` older files as <name>.1 (newest) ... <name>.N.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, backups: int, queue_size: int, description: str = "log"):
+        self.path = Path(path) if path else None
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.description = description
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._file = None
+        self._written = 0
+        self._dropped = 0
+
+    def log(self, record: dict) -> bool:
+        """Queues `record`; False if it was dropped."""
+        if self.path is None:
+            return False
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True, name=f"{self.description} writer")
+                self._worker.start()
+                atexit.register(self.flush)
+        try:
+            self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            return False
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self._write(record)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, record: dict):
+        if self.path is None:
+            return
+        try:
+            # Reopened when the file was removed (e.g. logs/ cleared by hand).
+            if self._file is None or not self.path.exists():
+                if self._file is not None:
+                    self._file.close()
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self._file.flush()
+            with self._lock:
+                self._written += 1
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+        except OSError as e:
+            print(f"Could not write the {self.description} '{self.path}': {e}. Disabling it.")
+            self.path = None
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{i}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backups > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    def flush(self):
+        """Blocks until every queued record is written."""
+        if self._worker is not None:
+            self._queue.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"written": self._written, "dropped": self._dropped, "queued": self._queue.qsize()}
+
+def _percentile(ordered: list, q: float) -> float:
+    # Nearest-rank, as for the time-to-first-token stats.
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+class Tracer:
+    """
+    Process-wide span recorder. Each finished span is folded into in-memory aggregates
+    (per-stage wall time, LLM token usage per model, cache hits and misses per cache) and
+    queued for a JsonlSink that writes and rotates the trace file off the request thread.
+    Spans started in worker threads are roots of their own trace.
+    """
+
+    def __init__(self, path: Path = TRACE_PATH, enabled: bool = TRACING_ENABLED, window: int = SPAN_WINDOW,
+                 max_bytes: int = TRACE_MAX_BYTES, backups: int = TRACE_BACKUPS, queue_size: int = TRACE_QUEUE_SIZE):
+        self.sink = JsonlSink(path, max_bytes, backups, queue_size, "trace file")
+        self.enabled = enabled
+        self.window = window
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._span_counts = defaultdict(int)
+        self._span_errors = defaultdict(int)
+        self._span_seconds = defaultdict(float)
+        self._tokens = defaultdict(int)
+        self._cache = defaultdict(int)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Times the enclosed block as stage `name`; yields the Span for adding attributes."""
+        parent = _current_span.get()
+        span = Span(name, parent.trace_id if parent else uuid.uuid4().hex[:16], uuid.uuid4().hex[:16],
+                    parent.span_id if parent else None, attrs)
+        if not self.enabled:
+            yield span
+            return
+        token = _current_span.set(span)
+        started_at, start = time.time(), time.perf_counter()
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span, started_at, time.perf_counter() - start, error)
+
+    def _finish(self, span: Span, started_at: float, seconds: float, error: str):
+        record = {
+            "ts": round(started_at, 6), "trace_id": span.trace_id, "span_id": span.span_id,
+            "parent_id": span.parent_id, "name": span.name, "duration_ms": round(seconds * 1000.0, 3),
+            "status": "error" if error else "ok", "attrs": span.attrs,
+        }
+        if error:
+            record["error"] = error
+        with self._lock:
+            self._durations.setdefault(span.name, deque(maxlen=self.window)).append(seconds)
+            self._span_counts[span.name] += 1
+            self._span_seconds[span.name] += seconds
+            self._span_errors[span.name] += bool(error)
+        # Metrics keep working in memory even if the trace file is given up.
+        self.sink.log(record)
+
+    def record(self, name: str, seconds: float, error: str = None, **attrs):
+        """Records a stage timed by the caller, e.g. a streamed completion whose work spans several yields."""
+        if not self.enabled:
+            return
+        parent = _current_span.get()
+        span = Span(name, parent.trace_id if parent else uuid.uuid4().hex[:16], uuid.uuid4().hex[:16],
+                    parent.span_id if parent else None, attrs)
+        self._finish(span, time.time() - seconds, seconds, error)
+
+    def record_usage(self, model_name: str, usage):
+        """Adds a completion's `usage` (prompt/completion tokens) to the model's totals and the current span."""
+        if not self.enabled or usage is None:
+            return
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        with self._lock:
+            self._tokens[(model_name, "prompt")] += prompt_tokens
+            self._tokens[(model_name, "completion")] += completion_tokens
+        span = _current_span.get()
+        if span is not None:
+            span.set(model=model_name, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def record_cache(self, cache_name: str, hits: int = 0, misses: int = 0):
+        """Counts cache hits and misses, and notes them on the current span."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._cache[(cache_name, "hit")] += hits
+            self._cache[(cache_name, "miss")] += misses
+        span = _current_span.get()
+        if span is not None:
+            span.set(**{f"{cache_name}_cache_hits": hits, f"{cache_name}_cache_misses": misses})
+
+    def stats(self) -> dict:
+        """Aggregates for display: per-stage count/errors/total and p50/p95, tokens per model, cache hit rates."""
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self._durations.items()}
+            counts, errors, seconds = dict(self._span_counts), dict(self._span_errors), dict(self._span_seconds)
+            tokens, cache = dict(self._tokens), dict(self._cache)
+        spans = {
+            name: {"count": counts[name], "errors": errors[name], "total_s": seconds[name],
+                   "p50_ms": 1000.0 * _percentile(ordered, 0.50), "p95_ms": 1000.0 * _percentile(ordered, 0.95)}
+            for name, ordered in durations.items()
+        }
+        models = {}
+        for (model_name, kind), n in tokens.items():
+            models.setdefault(model_name, {"prompt": 0, "completion": 0})[kind] = n
+        caches = {}
+        for (cache_name, result), n in cache.items():
+            caches.setdefault(cache_name, {"hit": 0, "miss": 0})[result] = n
+        for counters in caches.values():
+            lookups = counters["hit"] + counters["miss"]
+            counters["hit_rate"] = counters["hit"] / lookups if lookups else 0.0
+        return {"spans": spans, "tokens": models, "caches": caches}
+
+    def prometheus_text(self) -> str:
+        """The aggregates in the Prometheus text exposition format."""
+        stats = self.stats()
+        lines = ["# TYPE bu_stage_seconds summary"]
+        for name, span in sorted(stats["spans"].items()):
+            lines.append(f'bu_stage_seconds{{stage="{name}",quantile="0.5"}} {span["p50_ms"] / 1000.0:.6f}')
+            lines.append(f'bu_stage_seconds{{stage="{name}",quantile="0.95"}} {span["p95_ms"] / 1000.0:.6f}')
+            lines.append(f'bu_stage_seconds_sum{{stage="{name}"}} {span["total_s"]:.6f}')
+            lines.append(f'bu_stage_seconds_count{{stage="{name}"}} {span["count"]}')
+        lines.append("# TYPE bu_stage_errors_total counter")
+        for name, span in sorted(stats["spans"].items()):
+            lines.append(f'bu_stage_errors_total{{stage="{name}"}} {span["errors"]}')
+        lines.append("# TYPE bu_llm_tokens_total counter")
+        for model_name, counts in sorted(stats["tokens"].items()):
+            for kind in ("prompt", "completion"):
+                lines.append(f'bu_llm_tokens_total{{model="{model_name}",kind="{kind}"}} {counts[kind]}')
+        lines.append("# TYPE bu_cache_requests_total counter")
+        for cache_name, counts in sorted(stats["caches"].items()):
+            for result in ("hit", "miss"):
+                lines.append(f'bu_cache_requests_total{{cache="{cache_name}",result="{result}"}} {counts[result]}')
+        return "\n".join(lines) + "\n"
+
+TRACER = Tracer()
+
+def span(name: str, **attrs):
+    return TRACER.span(name, **attrs)
+
+def traced(name: str, **attrs):
+    """Decorator form of span(). Under a Streamlit cache decorator, only cache misses are traced."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with TRACER.span(name, **attrs):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def annotate(**attrs):
+    """Adds attributes to the innermost open span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attrs)
+
+def record_usage(model_name: str, usage):
+    TRACER.record_usage(model_name, usage)
+
+def record_cache(cache_name: str, hits: int = 0, misses: int = 0):
+    TRACER.record_cache(cache_name, hits, misses)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = TRACER.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@st.cache_resource
+def start_metrics_server(port: int):
+    """Serves TRACER.prometheus_text() at http://0.0.0.0:<port>/metrics from a daemon thread, once per process."""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-server").start()
+    return server